@@ -0,0 +1,261 @@
+# aggregation.py
+import calendar
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+TIME_OF_DAY_CODES = {'утро': 0, 'вечер': 1}
+MORNING, EVENING = 0, 1
+
+_DATE_LEN = 10
+_DOT = ord('.')
+_ZERO = ord('0')
+
+
+def parse_dates(date_strings) -> tuple:
+    """
+    Разбирает даты вида ДД.ММ.ГГГГ разом для всего массива.
+    Возвращает массивы (year, month, day, valid); для невалидных строк valid=False.
+    Строки в другом формате (например, «1.3.2025» после автоформата таблицы)
+    дочитываются поштучно — таких обычно единицы.
+    """
+    strings = np.asarray([str(s).strip() if s is not None else '' for s in date_strings], dtype=f'U{_DATE_LEN}')
+    count = len(strings)
+    if not count:
+        empty = np.zeros(0, dtype=np.int32)
+        return empty, empty, empty, np.zeros(0, dtype=bool)
+
+    # Каждый символ U-строки — 4 байта, поэтому строки можно рассмотреть как матрицу кодов символов
+    codes = strings.view(np.uint32).reshape(count, _DATE_LEN).astype(np.int32)
+    digits = codes - _ZERO
+    digit_cols = [0, 1, 3, 4, 6, 7, 8, 9]
+    valid = (codes[:, 2] == _DOT) & (codes[:, 5] == _DOT)
+    valid &= np.all((digits[:, digit_cols] >= 0) & (digits[:, digit_cols] <= 9), axis=1)
+
+    day = digits[:, 0] * 10 + digits[:, 1]
+    month = digits[:, 3] * 10 + digits[:, 4]
+    year = digits[:, 6] * 1000 + digits[:, 7] * 100 + digits[:, 8] * 10 + digits[:, 9]
+
+    for i in np.flatnonzero(~valid):
+        try:
+            parsed = datetime.strptime(strings[i], "%d.%m.%Y")
+        except ValueError:
+            continue
+        year[i], month[i], day[i], valid[i] = parsed.year, parsed.month, parsed.day, True
+
+    # Отсекаем несуществующие даты вроде 31.02
+    in_range = (month >= 1) & (month <= 12) & (day >= 1)
+    month_index = np.clip(month, 1, 12) - 1
+    leap = ((year % 4 == 0) & (year % 100 != 0)) | (year % 400 == 0)
+    days_in_month = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[month_index] + (leap & (month == 2))
+    valid &= in_range & (day <= days_in_month)
+    return np.where(valid, year, 0), np.where(valid, month, 0), np.where(valid, day, 0), valid
+
+
+def time_of_day_codes(values) -> np.ndarray:
+    """'утро' -> 0, 'вечер' -> 1, прочее -> -1."""
+    return np.array([TIME_OF_DAY_CODES.get((v or '').strip().lower(), -1) for v in values], dtype=np.int8)
+
+
+class DailyStats:
+    """
+    Дневные показатели, посчитанные одним векторизованным проходом:
+    максимум по утрам и вечерам, а также максимум, минимум, среднее и
+    суточная вариабельность ((max - min) / mean, %) за каждый день.
+    Отсутствующие значения — NaN.
+    """
+
+    def __init__(self, num_days: int, day_index, time_of_day, values):
+        self.num_days = num_days
+
+        day_index = np.asarray(day_index, dtype=np.int64)
+        time_of_day = np.asarray(time_of_day, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        mask = (day_index >= 0) & (day_index < num_days) & (time_of_day >= 0) & ~np.isnan(values)
+        day_index, time_of_day, values = day_index[mask], time_of_day[mask], values[mask]
+
+        # Группа = (день, время суток) -> одна ячейка плоского массива
+        groups = day_index * 2 + time_of_day
+        size = num_days * 2
+        group_max = np.full(size, -np.inf)
+        group_min = np.full(size, np.inf)
+        np.maximum.at(group_max, groups, values)
+        np.minimum.at(group_min, groups, values)
+        group_sum = np.bincount(groups, weights=values, minlength=size)
+        group_count = np.bincount(groups, minlength=size)
+
+        group_max = group_max.reshape(num_days, 2)
+        group_min = group_min.reshape(num_days, 2)
+        group_sum = group_sum.reshape(num_days, 2)
+        group_count = group_count.reshape(num_days, 2)
+
+        self.by_time_of_day_max = np.where(group_count == 0, np.nan, group_max)
+        self.count = group_count.sum(axis=1)
+        has_data = self.count > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.day_max = np.where(has_data, group_max.max(axis=1), np.nan)
+            self.day_min = np.where(has_data, group_min.min(axis=1), np.nan)
+            self.day_mean = np.where(has_data, group_sum.sum(axis=1) / self.count, np.nan)
+            self.variability = np.where(
+                self.count >= 2, (self.day_max - self.day_min) / self.day_mean * 100, np.nan
+            )
+
+    @property
+    def morning_max(self) -> np.ndarray:
+        return self.by_time_of_day_max[:, MORNING]
+
+    @property
+    def evening_max(self) -> np.ndarray:
+        return self.by_time_of_day_max[:, EVENING]
+
+    @property
+    def has_data(self) -> bool:
+        return bool(self.count.any())
+
+
+class MonthStats(DailyStats):
+    """Дневные показатели за календарный месяц (для графика)."""
+
+    def __init__(self, year: int, month: int, days, time_of_day, values):
+        self.year = year
+        self.month = month
+        super().__init__(
+            calendar.monthrange(year, month)[1], np.asarray(days, dtype=np.int64) - 1, time_of_day, values
+        )
+
+    @classmethod
+    def from_records(cls, records, year: int, month: int):
+        """Строит статистику из строк локального хранилища замеров."""
+        rows = [r for r in records if r['year'] == year and r['month'] == month and r['peakflow'] is not None]
+        return cls(
+            year, month,
+            [r['day'] for r in rows],
+            time_of_day_codes(r['time_of_day'] for r in rows),
+            [r['peakflow'] for r in rows],
+        )
+
+    @property
+    def labels(self) -> list:
+        return list(range(1, self.num_days + 1))
+
+
+class WindowStats(DailyStats):
+    """Дневные показатели за произвольный период start..end (для ИИ-анализа)."""
+
+    def __init__(self, start: date, end: date, dates, time_of_day, values):
+        self.start = start
+        self.end = end
+        # ISO-даты numpy разбирает сразу всем массивом
+        offsets = (np.array(list(dates), dtype='datetime64[D]') - np.datetime64(start, 'D')).astype(np.int64)
+        super().__init__((end - start).days + 1, offsets, time_of_day, values)
+
+    @classmethod
+    def from_records(cls, records, start: date, end: date):
+        rows = [r for r in records if r['peakflow'] is not None]
+        return cls(
+            start, end,
+            [r['date'] for r in rows],
+            time_of_day_codes(r['time_of_day'] for r in rows),
+            [r['peakflow'] for r in rows],
+        )
+
+    @property
+    def dates(self) -> list:
+        return [self.start + timedelta(days=i) for i in range(self.num_days)]
+
+
+def to_optional_ints(values) -> list:
+    """NaN -> None, остальное -> int; удобно для подписей графика и промптов."""
+    return [None if np.isnan(v) else int(v) for v in values]
+
+
+# --- Признаки для ИИ-анализа ---
+
+MED_CODES = {'базисная терапия': 'Б', 'назначения при болезни': 'Н'}
+SYMPTOM_CODES = (('breathing', 'Д'), ('cough', 'К'), ('sputum', 'М'))
+PROMPT_LEGEND = "Симптомы: Д — трудно дышать, К — кашель, М — мокрота. Лекарства: Б — базисная терапия, Н — назначения при болезни."
+# Зона ниже 80% личного максимума — «желтая»
+LOW_DAY_RATIO = 0.8
+
+
+def _yes(value) -> bool:
+    return str(value or '').strip().lower() == 'да'
+
+
+def _day_flags(records, start: date, num_days: int) -> list:
+    """Коды симптомов и лекарств по дням: ['ДК', '', ...], ['Б', '', ...]."""
+    symptoms = [set() for _ in range(num_days)]
+    meds = [set() for _ in range(num_days)]
+    for r in records:
+        index = (date.fromisoformat(r['date']) - start).days
+        if not 0 <= index < num_days:
+            continue
+        for field, code in SYMPTOM_CODES:
+            if _yes(r[field]):
+                symptoms[index].add(code)
+        code = MED_CODES.get(str(r['meds'] or '').strip().lower())
+        if code:
+            meds[index].add(code)
+    order = [code for _, code in SYMPTOM_CODES]
+    return (
+        [''.join(c for c in order if c in day) for day in symptoms],
+        [''.join(sorted(day)) for day in meds],
+    )
+
+
+def trend_slope(values) -> float | None:
+    """Наклон линейного тренда (единиц в день) по дням с данными."""
+    values = np.asarray(values, dtype=np.float64)
+    days = np.flatnonzero(~np.isnan(values))
+    if len(days) < 2:
+        return None
+    slope, _ = np.polyfit(days, values[days], 1)
+    return float(slope)
+
+
+def _fmt(value) -> str:
+    return '' if value is None or (isinstance(value, float) and np.isnan(value)) else str(int(round(value)))
+
+
+def prompt_features(records, start: date, end: date) -> str:
+    """
+    Компактное описание окна start..end для промпта: таблица по дням
+    (утро, вечер, симптомы, лекарства) и готовая сводка — средние, разброс,
+    тренд и дни ниже 80% личного максимума.
+    """
+    stats = WindowStats.from_records(records, start, end)
+    symptoms, meds = _day_flags(records, start, stats.num_days)
+
+    lines = ["день;утро;вечер;симптомы;лекарства"]
+    for i, day in enumerate(stats.dates):
+        if not stats.count[i] and not symptoms[i] and not meds[i]:
+            continue
+        lines.append(";".join((
+            day.strftime('%d.%m'), _fmt(stats.morning_max[i]), _fmt(stats.evening_max[i]), symptoms[i], meds[i],
+        )))
+
+    summary = []
+    with np.errstate(invalid='ignore'):
+        if stats.has_data:
+            best = np.nanmax(stats.day_max)
+            summary.append(f"личный максимум {_fmt(best)}")
+            for label, values in (("утро", stats.morning_max), ("вечер", stats.evening_max)):
+                if not np.all(np.isnan(values)):
+                    summary.append(f"среднее {label} {_fmt(np.nanmean(values))}")
+            if not np.all(np.isnan(stats.variability)):
+                worst = int(np.nanargmax(stats.variability))
+                summary.append(
+                    f"суточный разброс средний {_fmt(np.nanmean(stats.variability))}%, "
+                    f"максимальный {_fmt(stats.variability[worst])}% ({stats.dates[worst].strftime('%d.%m')})"
+                )
+            slope = trend_slope(stats.day_mean)
+            if slope is not None:
+                summary.append(f"тренд {slope:+.1f} л/мин в день")
+            low = np.flatnonzero(stats.day_max < best * LOW_DAY_RATIO)
+            low_days = ", ".join(stats.dates[i].strftime('%d.%m') for i in low)
+            summary.append(f"дни ниже 80% максимума: {low_days or 'нет'}")
+        symptom_days = sum(1 for day in symptoms if day)
+        summary.append(f"дней с симптомами {symptom_days}")
+
+    return "\n".join(lines) + "\nСводка: " + "; ".join(summary) + "."
+
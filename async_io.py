@@ -0,0 +1,116 @@
+# async_io.py
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import timed
+
+# Потоки и таймауты по внешним сервисам: медленный Google API не должен занимать всех
+SHEETS_IO_WORKERS = int(os.environ.get('SHEETS_IO_WORKERS', '4'))
+SHEETS_IO_TIMEOUT = float(os.environ.get('SHEETS_IO_TIMEOUT', '30'))
+FIRESTORE_IO_WORKERS = int(os.environ.get('FIRESTORE_IO_WORKERS', '8'))
+FIRESTORE_IO_TIMEOUT = float(os.environ.get('FIRESTORE_IO_TIMEOUT', '15'))
+# Локальный диск и SQLite: быстрые, но блокирующие вызовы тоже не должны идти в цикле событий
+STORAGE_IO_WORKERS = int(os.environ.get('STORAGE_IO_WORKERS', '4'))
+STORAGE_IO_TIMEOUT = float(os.environ.get('STORAGE_IO_TIMEOUT', '10'))
+GEMINI_CONCURRENCY = int(os.environ.get('GEMINI_CONCURRENCY', '8'))
+GEMINI_TIMEOUT = float(os.environ.get('GEMINI_TIMEOUT', '60'))
+
+
+class IOBackend:
+    """
+    Асинхронный фасад к одному внешнему сервису.
+
+    run() выполняет блокирующий вызов (gspread, Firestore) в собственном пуле
+    потоков сервиса, call() ждет нативную корутину (Gemini). В обоих случаях
+    одновременно выполняется не больше max_concurrency вызовов, а ожидание
+    ограничено timeout. Поток, не уложившийся в таймаут, занимает свой слот,
+    пока действительно не завершится, — зависший сервис не плодит потоки.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, timeout: float, threaded: bool = True):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f"{name}-io") if threaded else None
+        self._slots = None
+        self.waiting = 0
+        self.active = 0
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    async def _acquire(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+    def _release(self):
+        self.active -= 1
+        self._slots.release()
+
+    async def run(self, fn, *args, **kwargs):
+        """Выполняет блокирующую fn(*args, **kwargs) в пуле сервиса и возвращает результат."""
+        await self._acquire()
+        self.active += 1
+        self.calls += 1
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        # Слот освобождается по завершении потока, а не по таймауту ожидания
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        try:
+            with timed(self.name, getattr(fn, '__name__', 'call')):
+                return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            print(f"Таймаут вызова {self.name}: {getattr(fn, '__name__', fn)} дольше {self.timeout} с")
+            raise
+        except Exception:
+            self.errors += 1
+            raise
+
+    async def call(self, coro_fn, *args, **kwargs):
+        """Ждет нативную корутину coro_fn(*args, **kwargs) с тем же лимитом и таймаутом."""
+        await self._acquire()
+        self.active += 1
+        self.calls += 1
+        try:
+            with timed(self.name, getattr(coro_fn, '__name__', 'call')):
+                return await asyncio.wait_for(coro_fn(*args, **kwargs), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            print(f"Таймаут вызова {self.name}: {getattr(coro_fn, '__name__', coro_fn)} дольше {self.timeout} с")
+            raise
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        return {
+            'max_concurrency': self.max_concurrency,
+            'waiting': self.waiting,
+            'active': self.active,
+            'calls': self.calls,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+sheets_io = IOBackend('sheets', SHEETS_IO_WORKERS, SHEETS_IO_TIMEOUT)
+firestore_io = IOBackend('firestore', FIRESTORE_IO_WORKERS, FIRESTORE_IO_TIMEOUT)
+storage_io = IOBackend('storage', STORAGE_IO_WORKERS, STORAGE_IO_TIMEOUT)
+gemini_io = IOBackend('gemini', GEMINI_CONCURRENCY, GEMINI_TIMEOUT, threaded=False)
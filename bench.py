@@ -0,0 +1,869 @@
+# bench.py
+"""
+Нагрузочный прогон бота без сети: Telegram, Google Sheets, Firestore, Gemini
+и PostgreSQL заменены локальными заглушками с заданной задержкой.
+
+    python bench.py --save-baseline      # первый прогон: записать результаты как базовые
+    python bench.py                      # все сценарии, сравнение с bench_baseline.json
+    python bench.py --scenarios chart ai_report --users 100 --rows 50000
+    python bench.py --database-url postgresql://localhost/bench   # настоящий локальный PostgreSQL
+
+Сценарии проходят диалоги main_conv по его таблице состояний, ежемесячную
+рассылку графиков и обработку сообщений из main.py. Для каждого печатаются
+p50/p99 задержки, пропускная способность и пик памяти (tracemalloc)
+и изменение в процентах к базовым результатам. Без базовых результатов
+прогон запускается только с --save-baseline: иначе регрессию не с чем сравнить.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(BENCH_DIR, 'bench_baseline.json')
+
+_MONTH_NAMES = ["Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
+                "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь"]
+
+
+def _pause(ms: float):
+    if ms > 0:
+        time.sleep(ms / 1000)
+
+
+# --- Google Sheets ---
+
+class MemorySheet:
+    """Лист замеров в памяти с API gspread, которым пользуются MeasurementStore и MeasurementWriter."""
+
+    def __init__(self, rows: list, latency_ms: float = 0.0):
+        self.rows = rows
+        self.latency_ms = latency_ms
+        self._lock = threading.Lock()
+
+    @property
+    def row_count(self) -> int:
+        return len(self.rows)
+
+    def row_values(self, index: int) -> list:
+        _pause(self.latency_ms)
+        with self._lock:
+            return list(self.rows[index - 1]) if index <= len(self.rows) else []
+
+    def col_values(self, index: int) -> list:
+        _pause(self.latency_ms)
+        with self._lock:
+            return [row[index - 1] for row in self.rows if len(row) >= index]
+
+    def get(self, cell_range: str) -> list:
+        # Только открытые диапазоны вида "A15:L"
+        _pause(self.latency_ms)
+        start = int(cell_range.split(':')[0][1:])
+        with self._lock:
+            return [list(row) for row in self.rows[start - 1:]]
+
+    def append_rows(self, values: list, value_input_option=None) -> dict:
+        _pause(self.latency_ms)
+        with self._lock:
+            first = len(self.rows) + 1
+            self.rows.extend([str(v) for v in row] for row in values)
+            last = len(self.rows)
+        return {'updates': {'updatedRange': f"'Лист1'!A{first}:L{last}"}}
+
+    def update_cell(self, row: int, col: int, value):
+        _pause(self.latency_ms)
+        with self._lock:
+            self.rows[row - 1][col - 1] = value
+
+    def delete_rows(self, start: int, end: int = None):
+        _pause(self.latency_ms)
+        with self._lock:
+            del self.rows[start - 1:end]
+
+
+class MemorySheetsClient:
+    """Подменяет utils.sheets_client: get_sheet() возвращает MemorySheet."""
+
+    def __init__(self, sheet: MemorySheet):
+        self.sheet = sheet
+
+    def worksheet(self, title: str = None):
+        return self.sheet
+
+    def reset(self):
+        pass
+
+
+def generate_sheet_rows(num_rows: int, chat_ids: list, today: date) -> list:
+    """Заголовок и num_rows замеров: по два в день на чат, от сегодняшнего дня назад."""
+    from measurement_store import CHAT_ID_HEADER
+
+    header = ['№', 'Дата', 'Время', 'Время суток', 'Пикфлоуметр', 'Дыхание', 'Кашель',
+              'Мокрота', 'Лекарства', 'Возраст', 'Пол', CHAT_ID_HEADER]
+    rows = [header]
+    for i in range(num_rows):
+        chat_id = chat_ids[i % len(chat_ids)]
+        step = i // len(chat_ids)
+        day = today - timedelta(days=step // 2)
+        morning = step % 2 == 0
+        peakflow = 380 + (i * 37) % 90 - (0 if morning else 25)
+        rows.append([
+            str(i + 1), day.strftime("%d.%m.%Y"), "08:10:00" if morning else "20:30:00",
+            "утро" if morning else "вечер", str(peakflow),
+            "Да" if i % 11 == 0 else "Нет", "Да" if i % 7 == 0 else "Нет", "Нет",
+            "Базисная терапия" if i % 3 == 0 else "Нет", "7 лет", "мужской", str(chat_id),
+        ])
+    return rows
+
+
+# --- Firestore ---
+
+class _Snapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class _Watch:
+    def unsubscribe(self):
+        pass
+
+
+class MemoryDocument:
+    def __init__(self, db, path: tuple):
+        self._db = db
+        self.path = path
+        self.id = path[-1]
+
+    def collection(self, name: str):
+        return MemoryCollection(self._db, self.path + (name,))
+
+    def get(self):
+        self._db.pause()
+        with self._db.lock:
+            return _Snapshot(self, self._db.docs.get(self.path))
+
+    def set(self, data: dict, merge: bool = False):
+        self._db.pause()
+        self._db.write(self.path, data, merge)
+
+    def delete(self):
+        self._db.pause()
+        with self._db.lock:
+            self._db.docs.pop(self.path, None)
+
+
+class MemoryCollection:
+    def __init__(self, db, path: tuple, max_docs: int = None):
+        self._db = db
+        self.path = path
+        self._max_docs = max_docs
+
+    def document(self, doc_id: str):
+        return MemoryDocument(self._db, self.path + (doc_id,))
+
+    def limit(self, count: int):
+        return MemoryCollection(self._db, self.path, count)
+
+    def stream(self):
+        self._db.pause()
+        depth = len(self.path) + 1
+        with self._db.lock:
+            found = [
+                (path, data) for path, data in self._db.docs.items()
+                if len(path) == depth and path[:-1] == self.path
+            ]
+        return [_Snapshot(MemoryDocument(self._db, path), data) for path, data in found[:self._max_docs]]
+
+    def on_snapshot(self, callback):
+        # Изменения других процессов в прогоне не появляются
+        return _Watch()
+
+
+class MemoryBatch:
+    def __init__(self, db):
+        self._db = db
+        self._ops = []
+
+    def set(self, reference, data: dict, merge: bool = False):
+        self._ops.append((reference.path, data, merge))
+
+    def delete(self, reference):
+        self._ops.append((reference.path, None, False))
+
+    def commit(self):
+        self._db.pause()
+        for path, data, merge in self._ops:
+            if data is None:
+                with self._db.lock:
+                    self._db.docs.pop(path, None)
+            else:
+                self._db.write(path, data, merge)
+        self._ops = []
+
+
+class MemoryFirestore:
+    """Клиент Firestore в памяти: документы по полному пути, задержка на каждый RPC."""
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.docs = {}
+        self.lock = threading.Lock()
+
+    def pause(self):
+        _pause(self.latency_ms)
+
+    def write(self, path: tuple, data: dict, merge: bool):
+        with self.lock:
+            current = self.docs.get(path) if merge else None
+            self.docs[path] = {**(current or {}), **data}
+
+    def collection(self, name: str):
+        return MemoryCollection(self, (name,))
+
+    def batch(self):
+        return MemoryBatch(self)
+
+
+# --- Gemini ---
+
+class _StubResponse:
+    def __init__(self, text: str, chunks: int, delay: float):
+        self.text = text
+        self._chunks = chunks
+        self._delay = delay
+
+    def __aiter__(self):
+        return self._stream()
+
+    async def _stream(self):
+        size = max(1, len(self.text) // self._chunks)
+        for i in range(0, len(self.text), size):
+            await asyncio.sleep(self._delay)
+            yield _StubResponse(self.text[i:i + size], 1, 0)
+
+
+class StubGeminiModel:
+    """Модель с фиксированным ответом: latency_ms до полного ответа, поток — равными частями."""
+
+    def __init__(self, latency_ms: float, chunks: int = 8, reply_chars: int = 600):
+        self.latency_ms = latency_ms
+        self.chunks = chunks
+        self.reply = ("Показатели стабильные, утром немного выше, чем вечером. " * 20)[:reply_chars]
+        self.calls = 0
+
+    async def generate_content_async(self, prompt, stream: bool = False):
+        self.calls += 1
+        if stream:
+            # Первый фрагмент приходит через половину задержки, остальные — следом
+            await asyncio.sleep(self.latency_ms / 2000)
+            return _StubResponse(self.reply, self.chunks, self.latency_ms / 2000 / self.chunks)
+        await asyncio.sleep(self.latency_ms / 1000)
+        return _StubResponse(self.reply, 1, 0)
+
+    def start_chat(self, history=None):
+        return _StubChat(self)
+
+
+class _StubChat:
+    def __init__(self, model: StubGeminiModel):
+        self._model = model
+
+    async def send_message_async(self, text, stream: bool = False):
+        return await self._model.generate_content_async(text, stream=stream)
+
+
+# --- PostgreSQL ---
+
+class _StubCursor:
+    def __init__(self, conn):
+        self.connection = conn
+        self._result = []
+        self._values = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def mogrify(self, template, args) -> bytes:
+        # extras.execute_values собирает строки через mogrify, а затем выполняет один INSERT
+        self._values.append(tuple(args))
+        return b'(' + b','.join(b'%s' for _ in args) + b')'
+
+    def execute(self, sql, params=()):
+        self.connection.db.pause()
+        if isinstance(sql, bytes):
+            self.connection.db.insert_history(self._values)
+            self._values = []
+            self._result = []
+        else:
+            self._result = self.connection.db.execute(sql, params or ())
+
+    def fetchall(self):
+        return list(self._result)
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+
+class _StubConnection:
+    encoding = 'UTF8'
+
+    def __init__(self, db):
+        self.db = db
+        self.closed = 0
+
+    def cursor(self):
+        return _StubCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class StubPostgres:
+    """
+    Заменяет psycopg2 ThreadedConnectionPool внутри db.ConnectionPool: выдача
+    соединений, метрики и WriteBehindBuffer работают как обычно, а запросы
+    main.py и context_builder.py выполняются над словарями в памяти.
+    """
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.history = {}
+        self.summaries = {}
+        self._lock = threading.Lock()
+
+    def pause(self):
+        _pause(self.latency_ms)
+
+    # API ThreadedConnectionPool
+    def getconn(self):
+        return _StubConnection(self)
+
+    def putconn(self, conn, close: bool = False):
+        if close:
+            conn.close()
+
+    def closeall(self):
+        pass
+
+    def insert_history(self, rows):
+        with self._lock:
+            for user_id, role, content, timestamp in rows:
+                self.history.setdefault(user_id, []).append((role, content, timestamp))
+
+    def _recent(self, user_id, limit):
+        rows = sorted(self.history.get(user_id, []), key=lambda r: r[2])
+        return rows[-limit:]
+
+    def execute(self, sql: str, params: tuple) -> list:
+        with self._lock:
+            if "WITH upserted" in sql:
+                user_id, _, _, content, timestamp = params[:5]
+                rows = self._recent(user_id, params[6]) if "SELECT role" in sql else [(1,)]
+                self.history.setdefault(user_id, []).append(('user', content, timestamp))
+                return rows
+            if "FROM chat_summaries" in sql:
+                found = self.summaries.get(params[0])
+                return [found] if found else []
+            if "INSERT INTO chat_summaries" in sql:
+                self.summaries[params[0]] = (params[1], params[2])
+                return []
+            if sql.strip().startswith("SELECT 1"):
+                return [(1,)]
+            return []
+
+
+# --- Telegram ---
+
+class _Photo:
+    def __init__(self, file_id: str):
+        self.file_id = file_id
+
+
+class _Chat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+
+class _User:
+    def __init__(self, user_id: int, first_name: str):
+        self.id = user_id
+        self.first_name = first_name
+        self.username = f"user{user_id}"
+
+
+class FakeMessage:
+    def __init__(self, bot, chat_id: int, text: str = None, from_user=None, photo=None):
+        self._bot = bot
+        self.chat_id = chat_id
+        self.chat = _Chat(chat_id)
+        self.text = text
+        self.from_user = from_user
+        self.photo = photo or []
+
+    async def reply_text(self, text, **kwargs):
+        return await self._bot.send_message(chat_id=self.chat_id, text=text)
+
+    async def edit_text(self, text, **kwargs):
+        await self._bot.pause()
+        self._bot.edits += 1
+        self.text = text
+        return self
+
+
+class FakeBot:
+    """Бот Telegram: ответы не уходят в сеть, а только считаются, с задержкой на вызов API."""
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.messages = 0
+        self.photos = 0
+        self.edits = 0
+        self._file_ids = itertools.count(1)
+
+    async def pause(self):
+        if self.latency_ms > 0:
+            await asyncio.sleep(self.latency_ms / 1000)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.pause()
+        self.messages += 1
+        return FakeMessage(self, chat_id, text)
+
+    async def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        await self.pause()
+        self.photos += 1
+        return FakeMessage(self, chat_id, caption, photo=[_Photo(f"photo-{next(self._file_ids)}")])
+
+
+class FakeUpdate:
+    def __init__(self, bot, chat_id: int, first_name: str, text: str):
+        user = _User(chat_id, first_name)
+        self.message = FakeMessage(bot, chat_id, text, from_user=user)
+        self.effective_message = self.message
+        self.effective_chat = self.message.chat
+        self.effective_user = user
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.jobs = []
+
+    def get_jobs_by_name(self, name):
+        return [job for job in self.jobs if job[0] == name]
+
+    def run_once(self, callback, when, name=None, **kwargs):
+        self.jobs.append((name, callback, when))
+
+
+class FakeApplication:
+    def __init__(self, bot):
+        self.bot = bot
+        self.job_queue = FakeJobQueue()
+
+    def create_task(self, coro):
+        return asyncio.get_running_loop().create_task(coro)
+
+
+class FakeContext:
+    def __init__(self, application: FakeApplication):
+        self.application = application
+        self.bot = application.bot
+        self.job_queue = application.job_queue
+        self.user_data = {}
+
+
+# --- Окружение прогона ---
+
+class BenchEnvironment:
+    """Поднимает handlers.py и main.py поверх заглушек в отдельном временном каталоге."""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix='bot-bench-')
+        self.cwd = os.getcwd()
+        self.chat_ids = [100000 + i for i in range(args.users)]
+        self.today = date.today()
+
+    def setup(self):
+        args = self.args
+        # Локальные копии (profiles.json, SQLite, журналы, кэш графиков) пишутся во временный каталог
+        os.chdir(self.workdir)
+        os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'bench')
+        os.environ.setdefault('GEMINI_API_KEY', 'bench')
+        os.environ['DATABASE_URL'] = args.database_url or 'postgresql://bench-stub/bench'
+        # Лимит рассылки Telegram иначе определял бы время ежемесячного прогона целиком
+        os.environ['BROADCAST_RATE'] = str(args.broadcast_rate)
+        if BENCH_DIR not in sys.path:
+            sys.path.insert(0, BENCH_DIR)
+
+        import utils
+        self.sheet = MemorySheet(generate_sheet_rows(args.rows, self.chat_ids, self.today), args.sheets_ms)
+        utils.sheets_client = MemorySheetsClient(self.sheet)
+        self.firestore = MemoryFirestore(args.firestore_ms)
+        utils.db_firestore = self.firestore
+        utils.app_id_global = 'bench'
+
+        import handlers
+        import main
+        self.handlers = handlers
+        self.main = main
+        self.gemini = StubGeminiModel(args.gemini_ms)
+        handlers.report_model = self.gemini
+        main.model = self.gemini
+        main.context_builder.model = self.gemini
+        if not args.database_url:
+            main.db_pool._pool = StubPostgres(args.db_ms)
+        else:
+            main.init_db()
+        main.reply_buffer.start()
+
+        self.bot = FakeBot(args.telegram_ms)
+        self.application = FakeApplication(self.bot)
+
+        from state_cache import Profile, Reminder
+        for i, chat_id in enumerate(self.chat_ids):
+            handlers.profile_state.set(chat_id, Profile(dob="01.02.2018", sex="мужской", first_name=f"Bench{i}"))
+            handlers.reminder_state.set(chat_id, Reminder(times=["08:00", "20:30"]))
+
+    async def warm_up(self):
+        # Первая синхронизация читает весь лист — это разовая стоимость старта, а не сценариев
+        await self.handlers.sync_measurements()
+
+    def context(self) -> FakeContext:
+        return FakeContext(self.application)
+
+    def update(self, chat_id: int, text: str) -> FakeUpdate:
+        return FakeUpdate(self.bot, chat_id, f"Bench{chat_id - 100000}", text)
+
+    async def converse(self, chat_id: int, entry, replies: list):
+        """Проходит диалог main_conv: entry, затем обработчик текущего состояния на каждый ответ."""
+        conv = self.handlers.main_conv
+        context = self.context()
+        state = await entry(self.update(chat_id, None), context)
+        for text in replies:
+            if state not in conv.states:
+                raise RuntimeError(f"Диалог завершился раньше времени (состояние {state}) на ответе {text!r}")
+            state = await conv.states[state][0].callback(self.update(chat_id, text), context)
+        if state != conv.END:
+            raise RuntimeError(f"Диалог не завершился: состояние {state}")
+
+    def previous_month(self) -> tuple:
+        last_day = self.today.replace(day=1) - timedelta(days=1)
+        return last_day.year, last_day.month
+
+    def shutdown(self):
+        self.main.reply_buffer.close()
+        self.handlers.chart_renderer.shutdown()
+        for backend in (self.handlers.sheets_io, self.handlers.firestore_io, self.handlers.storage_io, self.handlers.gemini_io):
+            backend.shutdown()
+        for store in (self.handlers.profile_state.store, self.handlers.reminder_state.store, self.handlers.charts_sent_store):
+            store.flush_local()
+        self.handlers.chart_cache.stop()
+        self.handlers.measurement_store.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+# --- Сценарии ---
+
+class Scenario:
+    """Одна операция на пользователя за раунд; before_round() готовит состояние раунда."""
+
+    name = None
+    description = None
+
+    def __init__(self, env: BenchEnvironment):
+        self.env = env
+
+    async def before_round(self):
+        pass
+
+    def participants(self) -> list:
+        return self.env.chat_ids
+
+    async def run(self, chat_id) -> int:
+        """Выполняет операцию и возвращает число обработанных единиц (для пропускной способности)."""
+        raise NotImplementedError
+
+
+class MeasurementScenario(Scenario):
+    name = 'measurement'
+    description = "диалог замера до get_meds_and_save"
+
+    async def run(self, chat_id) -> int:
+        handlers = self.env.handlers
+        await self.env.converse(chat_id, handlers.start_logging, ["410", "Нет", "Да", "Нет", "Базисная терапия"])
+        return 1
+
+
+class ChartScenario(Scenario):
+    name = 'chart'
+    description = "выбор месяца и отрисовка графика, кэш графиков пуст"
+
+    async def before_round(self):
+        self.env.handlers.chart_cache.clear()
+
+    async def run(self, chat_id) -> int:
+        year, month = self.env.previous_month()
+        await self.env.converse(chat_id, self.env.handlers.chart_start, [f"{_MONTH_NAMES[month - 1]} {year}"])
+        return 1
+
+
+class AIReportScenario(Scenario):
+    name = 'ai_report'
+    description = "ИИ-анализ за две недели, кэш отчетов пуст"
+
+    async def before_round(self):
+        self.env.handlers.report_cache.clear()
+
+    async def run(self, chat_id) -> int:
+        await self.env.handlers.ai_report(self.env.update(chat_id, "🤖 Анализ ИИ"), self.env.context())
+        return 1
+
+
+class _FirstOfMonth(date):
+    # send_monthly_chart_to_users работает только первого числа
+    @classmethod
+    def today(cls):
+        return date.today().replace(day=1)
+
+
+class MonthlyJobScenario(Scenario):
+    name = 'monthly_job'
+    description = "ежемесячная рассылка графиков всем пользователям"
+
+    def participants(self) -> list:
+        return [None]
+
+    async def before_round(self):
+        handlers = self.env.handlers
+        handlers.chart_cache.clear()
+        await handlers.firestore_io.run(handlers.charts_sent_store.clear)
+        from broadcast import CHARTS_SENT_JOURNAL
+        if os.path.exists(CHARTS_SENT_JOURNAL):
+            os.remove(CHARTS_SENT_JOURNAL)
+
+    async def run(self, chat_id) -> int:
+        handlers = self.env.handlers
+        photos = self.env.bot.photos
+        handlers.date = _FirstOfMonth
+        try:
+            await handlers.send_monthly_chart_to_users(self.env.context())
+        finally:
+            handlers.date = date
+        return self.env.bot.photos - photos
+
+
+class ChatScenario(Scenario):
+    name = 'handle_message'
+    description = "сообщение в чат Gemini (main.py)"
+
+    def __init__(self, env: BenchEnvironment):
+        super().__init__(env)
+        self._turns = itertools.count(1)
+
+    async def run(self, chat_id) -> int:
+        text = f"Вопрос номер {next(self._turns)}: как часто делать замеры?"
+        await self.env.main.handle_message(self.env.update(chat_id, text), self.env.context())
+        return 1
+
+
+SCENARIOS = {cls.name: cls for cls in (MeasurementScenario, ChartScenario, AIReportScenario, MonthlyJobScenario, ChatScenario)}
+
+
+# --- Замеры ---
+
+def percentile(values: list, percent: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+async def _round(scenario: Scenario, latencies: list) -> int:
+    await scenario.before_round()
+
+    async def one(chat_id):
+        started = time.perf_counter()
+        units = await scenario.run(chat_id)
+        latencies.append(time.perf_counter() - started)
+        return units
+
+    return sum(await asyncio.gather(*(one(chat_id) for chat_id in scenario.participants())))
+
+
+async def measure(scenario: Scenario, rounds: int) -> dict:
+    """Раунды: все пользователи сценария одновременно. Память — отдельным раундом под tracemalloc."""
+    latencies = []
+    units = 0
+    started = time.perf_counter()
+    for _ in range(rounds):
+        units += await _round(scenario, latencies)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    try:
+        await _round(scenario, [])
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'ops_per_s': round(units / elapsed, 2),
+        'peak_kib': round(peak / 1024, 1),
+        'ops': len(latencies),
+    }
+
+
+# --- Базовые результаты ---
+
+# Для задержек и памяти рост — ухудшение, для пропускной способности — улучшение
+_LOWER_IS_BETTER = {'p50_ms': True, 'p99_ms': True, 'ops_per_s': False, 'peak_kib': True}
+
+
+def load_baseline(path: str) -> dict:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Ошибка чтения базовых результатов {path}: {e}")
+        return {}
+
+
+def save_baseline(path: str, config: dict, results: dict):
+    baseline = load_baseline(path)
+    baseline['config'] = config
+    baseline.setdefault('scenarios', {}).update(results)
+    baseline['recorded_at'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(baseline, f, ensure_ascii=False, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def regressions(result: dict, base: dict, threshold: float) -> tuple:
+    """({метрика: изменение в %}, метрики, ухудшившиеся больше чем на threshold %)."""
+    changes, worse = {}, []
+    for metric, lower_is_better in _LOWER_IS_BETTER.items():
+        old, new = base.get(metric), result.get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        changes[metric] = change
+        if (change if lower_is_better else -change) > threshold:
+            worse.append(metric)
+    return changes, worse
+
+
+def print_report(results: dict, baseline: dict, threshold: float) -> list:
+    failed = []
+    base_scenarios = baseline.get('scenarios', {})
+    print(f"{'сценарий':<16}{'p50, мс':>10}{'p99, мс':>10}{'оп/с':>10}{'пик, КиБ':>11}   к базовым")
+    for name, result in results.items():
+        line = f"{name:<16}{result['p50_ms']:>10}{result['p99_ms']:>10}{result['ops_per_s']:>10}{result['peak_kib']:>11}"
+        base = base_scenarios.get(name)
+        if base:
+            changes, worse = regressions(result, base, threshold)
+            line += "   " + " ".join(f"{metric} {change:+.1f}%" for metric, change in changes.items())
+            if worse:
+                line += "   ХУЖЕ"
+                failed.append(name)
+        print(line)
+    return failed
+
+
+def _config(args) -> dict:
+    return {
+        'users': args.users, 'rounds': args.rounds, 'rows': args.rows,
+        'sheets_ms': args.sheets_ms, 'firestore_ms': args.firestore_ms, 'gemini_ms': args.gemini_ms,
+        'telegram_ms': args.telegram_ms, 'db_ms': args.db_ms, 'broadcast_rate': args.broadcast_rate,
+        'database': 'postgres' if args.database_url else 'stub',
+    }
+
+
+async def run_benchmarks(args) -> dict:
+    env = BenchEnvironment(args)
+    env.setup()
+    try:
+        await env.warm_up()
+        results = {}
+        for name in args.scenarios:
+            scenario = SCENARIOS[name](env)
+            print(f"{name}: {scenario.description}...", flush=True)
+            results[name] = await measure(scenario, args.rounds)
+        return results
+    finally:
+        env.shutdown()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Локальный нагрузочный прогон бота на заглушках внешних сервисов.")
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--users', type=int, default=50, help="одновременных пользователей в раунде")
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--rows', type=int, default=20000, help="строк в листе замеров")
+    parser.add_argument('--sheets-ms', type=float, default=150.0)
+    parser.add_argument('--firestore-ms', type=float, default=30.0)
+    parser.add_argument('--gemini-ms', type=float, default=1500.0)
+    parser.add_argument('--telegram-ms', type=float, default=40.0)
+    parser.add_argument('--db-ms', type=float, default=5.0, help="задержка заглушки PostgreSQL")
+    parser.add_argument('--broadcast-rate', type=float, default=1000.0, help="лимит рассылки в прогоне, сообщений/с")
+    parser.add_argument('--database-url', help="локальный PostgreSQL вместо заглушки")
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--max-regression', type=float, default=20.0,
+                        help="допустимое ухудшение метрики, %%; больше — код выхода 1")
+    parser.add_argument('--json', action='store_true', help="вывести результаты в JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    baseline = load_baseline(args.baseline)
+    if not baseline and not args.save_baseline:
+        print(f"Нет базовых результатов в {args.baseline}: запишите их, запустив с --save-baseline "
+              f"с теми же параметрами на той же машине.")
+        return 2
+    results = asyncio.run(run_benchmarks(args))
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    if baseline and baseline.get('config') != _config(args):
+        print("Внимание: параметры прогона отличаются от базовых, сравнение приблизительное.")
+    failed = print_report(results, baseline, args.max_regression)
+    if args.save_baseline:
+        save_baseline(args.baseline, _config(args), results)
+        print(f"Базовые результаты сохранены в {args.baseline}")
+        return 0
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    # Пул отрисовки графиков запускает процессы через spawn и заново импортирует этот модуль
+    sys.exit(main())
@@ -0,0 +1,226 @@
+# broadcast.py
+import asyncio
+import inspect
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from rate_limit import TokenBucket
+
+CHARTS_SENT_JOURNAL = os.environ.get('CHARTS_SENT_JOURNAL', 'charts_sent.journal')
+MONTHLY_FANOUT_CONCURRENCY = int(os.environ.get('MONTHLY_FANOUT_CONCURRENCY', '32'))
+# Общий лимит Telegram на массовую рассылку — около 30 сообщений в секунду
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '25'))
+# В один чат Telegram разрешает примерно одно сообщение в секунду
+PER_CHAT_RATE = float(os.environ.get('PER_CHAT_RATE', '1'))
+DISPATCH_CONCURRENCY = int(os.environ.get('DISPATCH_CONCURRENCY', '16'))
+DISPATCH_MAX_ATTEMPTS = 3
+# Сколько последних задержек доставки хранить для перцентилей
+_LATENCY_WINDOW = 1000
+# Сколько поминутных лимитеров чатов держать в памяти
+_CHAT_BUCKETS_LIMIT = 10000
+
+
+class DeliveryCheckpoint:
+    """
+    Учет доставленных рассылок, переживающий падение посреди прогона.
+    Каждая доставка сразу дописывается в локальный журнал, а в основное
+    хранилище каждые flush_every доставок и в конце уходят записи только
+    изменившихся чатов: save получает {chat_id: [ключи]} для них.
+    """
+
+    def __init__(self, load, save, journal_path=CHARTS_SENT_JOURNAL, flush_every=25):
+        self._load = load
+        self._save = save
+        self.journal_path = journal_path
+        self.flush_every = flush_every
+        self.data = {}
+        self._dirty = set()
+        self._since_flush = 0
+        # mark может вызываться из пула потоков ввода-вывода
+        self._lock = threading.RLock()
+
+    def load(self) -> dict:
+        self.data = self._load() or {}
+        # Доставки из журнала прерванного прогона, не успевшие попасть в хранилище
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    self._remember(entry['chat_id'], entry['key'])
+        except FileNotFoundError:
+            pass
+        except (OSError, json.JSONDecodeError, KeyError) as e:
+            print(f"Ошибка чтения журнала рассылки {self.journal_path}: {e}")
+        return self.data
+
+    def _remember(self, chat_id: str, key: str):
+        keys = self.data.setdefault(chat_id, [])
+        if key not in keys:
+            keys.append(key)
+            self._dirty.add(chat_id)
+
+    def is_done(self, chat_id: str, key: str) -> bool:
+        return key in self.data.get(chat_id, [])
+
+    def mark(self, chat_id: str, key: str):
+        with self._lock:
+            self._remember(chat_id, key)
+            try:
+                with open(self.journal_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({'chat_id': chat_id, 'key': key}) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                print(f"Ошибка записи в журнал рассылки: {e}")
+            self._since_flush += 1
+            if self._since_flush >= self.flush_every:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._save({chat_id: list(self.data[chat_id]) for chat_id in self._dirty})
+                self._dirty = set()
+            self._since_flush = 0
+
+    def finish(self):
+        self.flush()
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+
+
+async def fan_out(items, worker, concurrency=MONTHLY_FANOUT_CONCURRENCY):
+    """
+    Выполняет worker(item) для всех элементов, не больше concurrency одновременно.
+    Исключения отдельных элементов не прерывают прогон и возвращаются в результатах.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(item):
+        async with semaphore:
+            return await worker(item)
+
+    return await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
+
+
+class MessageDispatcher:
+    """
+    Рассылка пачек сообщений с учетом лимитов Telegram.
+
+    Каждое сообщение проходит через лимитер своего чата и общий лимитер бота.
+    На 429 общий лимитер замирает на retry_after, сетевые сбои повторяются
+    с паузой, постоянные ошибки запроса (BadRequest) — нет. Для чатов,
+    заблокировавших бота, вызывается on_blocked(chat_id) — функция или
+    корутина, которая убирает их из хранилища; если пользователь снова
+    подпишется, сообщения пойдут ему как обычно.
+    Задержка доставки считается от запланированного времени отправки.
+    """
+
+    def __init__(self, rate=BROADCAST_RATE, per_chat_rate=PER_CHAT_RATE,
+                 concurrency=DISPATCH_CONCURRENCY, max_attempts=DISPATCH_MAX_ATTEMPTS, on_blocked=None):
+        self.limiter = TokenBucket(rate)
+        self.per_chat_rate = per_chat_rate
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.on_blocked = on_blocked
+        self._chat_buckets = OrderedDict()
+        self.blocked = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.failures = Counter()
+        self.latencies = deque(maxlen=_LATENCY_WINDOW)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, 1)
+            if len(self._chat_buckets) > _CHAT_BUCKETS_LIMIT:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def send_batch(self, bot, chat_ids, text: str, scheduled_at: float = None) -> int:
+        """Отправляет text во все чаты пачки; возвращает число доставленных сообщений."""
+        scheduled_at = scheduled_at if scheduled_at is not None else time.time()
+        results = await fan_out(chat_ids, lambda chat_id: self._send_one(bot, chat_id, text, scheduled_at), self.concurrency)
+        return sum(1 for result in results if result is True)
+
+    async def _send_one(self, bot, chat_id, text: str, scheduled_at: float) -> bool:
+        for attempt in range(1, self.max_attempts + 1):
+            # Сначала ждем свой чат, чтобы не держать общий токен впустую
+            await self._chat_bucket(chat_id).acquire()
+            await self.limiter.acquire()
+            try:
+                await bot.send_message(chat_id=int(chat_id), text=text)
+            except RetryAfter as e:
+                # Лимит превышен для всего бота — притормаживаем всю рассылку
+                self.limiter.pause(e.retry_after)
+                error = e
+            except Forbidden as e:
+                await self._mark_blocked(chat_id)
+                self._record_failure(e)
+                return False
+            except BadRequest as e:
+                # Подкласс NetworkError, но повтор не поможет (например, «chat not found»)
+                self._record_failure(e)
+                print(f"Ошибка отправки в чат {chat_id}: {e}")
+                return False
+            except (TimedOut, NetworkError) as e:
+                await asyncio.sleep(attempt)
+                error = e
+            except Exception as e:
+                self._record_failure(e)
+                print(f"Ошибка отправки в чат {chat_id}: {e}")
+                return False
+            else:
+                self.sent += 1
+                self.latencies.append(time.time() - scheduled_at)
+                return True
+            if attempt < self.max_attempts:
+                self.retried += 1
+        self._record_failure(error)
+        print(f"Не удалось отправить сообщение в чат {chat_id} за {self.max_attempts} попытки: {error}")
+        return False
+
+    def _record_failure(self, error: Exception):
+        self.failed += 1
+        self.failures[type(error).__name__] += 1
+
+    async def _mark_blocked(self, chat_id):
+        self.blocked += 1
+        self._chat_buckets.pop(chat_id, None)
+        if self.on_blocked:
+            try:
+                result = self.on_blocked(chat_id)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"Ошибка обработки заблокированного чата {chat_id}: {e}")
+
+    def latency_percentile(self, percent: float):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def stats(self) -> dict:
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'blocked': self.blocked,
+            'failures': dict(self.failures),
+            'latency_p50': self.latency_percentile(50),
+            'latency_p95': self.latency_percentile(95),
+        }
@@ -0,0 +1,240 @@
+# chart_cache.py
+import atexit
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+CHART_CACHE_DIR = os.environ.get('CHART_CACHE_DIR', 'chart_cache')
+CHART_CACHE_MB = int(os.environ.get('CHART_CACHE_MB', '100'))
+# Через сколько секунд после изменения переписывать индекс кэша
+CHART_CACHE_FLUSH_DELAY = float(os.environ.get('CHART_CACHE_FLUSH_DELAY', '2'))
+_INDEX_FILE = 'index.json'
+
+
+def chart_key(chat_id, year: int, month: int, version: int) -> str:
+    return f"{chat_id}:{year}-{month:02d}:v{version}"
+
+
+def _month_prefix(key: str) -> str:
+    return key.rsplit(':v', 1)[0]
+
+
+class ChartCache:
+    """
+    Дисковый кэш готовых PNG-графиков.
+
+    Ключ — (chat_id, год, месяц, версия данных): после записи нового замера
+    версия месяца меняется, и старый график просто перестает находиться.
+    Файлы названы по хэшу содержимого, одинаковые картинки хранятся один раз.
+    Вместе с файлом запоминается file_id Telegram, чтобы повторно отправлять
+    график без загрузки. Вытеснение — LRU: порядок обращений и занятый объем
+    держатся в памяти, каталог сканируется только при запуске, а индекс
+    переписывается с задержкой — серия изменений дает одну запись файла.
+    """
+
+    def __init__(self, directory=CHART_CACHE_DIR, max_bytes=CHART_CACHE_MB * 1024 * 1024,
+                 flush_delay=CHART_CACHE_FLUSH_DELAY):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.flush_delay = flush_delay
+        self._lock = threading.Lock()
+        self._timer = None
+        self._dirty = False
+        os.makedirs(directory, exist_ok=True)
+        # Ключ -> {'digest', 'file_id'}; от давно не использованных к недавним
+        self._index = OrderedDict()
+        self._sizes = OrderedDict()  # digest -> размер файла, в том же LRU-порядке
+        self._keys = {}              # digest -> ключи, ссылающиеся на файл
+        self._versions = {}          # chat_id:год-месяц -> ключ актуальной версии
+        self._bytes = 0
+        self._load()
+        self.hits = 0
+        self.misses = 0
+        atexit.register(self.flush)
+
+    # --- Индекс ---
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.directory, _INDEX_FILE), 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {}
+        sizes = {}
+        for name in os.listdir(self.directory):
+            if name.endswith('.png'):
+                sizes[name[:-4]] = os.path.getsize(os.path.join(self.directory, name))
+        for key, entry in index.items():
+            digest = entry.get('digest')
+            if digest not in sizes:
+                digest = None
+            if digest is None and not entry.get('file_id'):
+                continue
+            self._add_entry(key, {'digest': digest, 'file_id': entry.get('file_id')}, sizes)
+        # Файлы, на которые не ссылается индекс, остались от прерванной работы
+        for digest in set(sizes) - set(self._sizes):
+            self._remove_file(digest)
+        self._evict()
+
+    def _add_entry(self, key: str, entry: dict, sizes: dict):
+        # Сначала ссылка на новый файл: прежняя версия может указывать на тот же
+        digest = entry['digest']
+        if digest is not None:
+            if digest not in self._sizes:
+                self._sizes[digest] = sizes[digest]
+                self._bytes += sizes[digest]
+            self._keys.setdefault(digest, set()).add(key)
+            self._sizes.move_to_end(digest)
+        previous = self._index.pop(key, None)
+        if previous is not None and previous['digest'] != digest:
+            self._unlink_digest(key, previous)
+        # Прежние версии того же месяца больше не понадобятся
+        prefix = _month_prefix(key)
+        stale = self._versions.get(prefix)
+        if stale is not None and stale != key:
+            self._drop(stale)
+        self._versions[prefix] = key
+        self._index[key] = entry
+
+    def _drop(self, key: str):
+        entry = self._index.pop(key, None)
+        if entry is None:
+            return
+        if self._versions.get(_month_prefix(key)) == key:
+            del self._versions[_month_prefix(key)]
+        self._unlink_digest(key, entry)
+
+    def _unlink_digest(self, key: str, entry: dict):
+        digest = entry['digest']
+        if digest is None:
+            return
+        keys = self._keys[digest]
+        keys.discard(key)
+        if not keys:
+            del self._keys[digest]
+            self._bytes -= self._sizes.pop(digest)
+            self._remove_file(digest)
+
+    def _remove_file(self, digest: str):
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        """Удаляет давно не использованные файлы, пока объем не уложится в лимит."""
+        while self._bytes > self.max_bytes and self._sizes:
+            digest = next(iter(self._sizes))
+            for key in list(self._keys[digest]):
+                entry = self._index[key]
+                # С file_id график можно отправить и без файла
+                if entry['file_id']:
+                    self._unlink_digest(key, entry)
+                    entry['digest'] = None
+                else:
+                    self._drop(key)
+
+    def _schedule_flush(self):
+        # Вызывается под self._lock
+        self._dirty = True
+        if self._timer is not None:
+            return
+        self._timer = threading.Timer(self.flush_delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        """Переписывает индекс, если он менялся с прошлой записи."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            self._dirty = False
+            data = json.dumps(self._index)
+        path = os.path.join(self.directory, _INDEX_FILE)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Ошибка сохранения индекса кэша графиков: {e}")
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, f"{digest}.png")
+
+    # --- Чтение и запись ---
+
+    def get(self, key: str):
+        """Возвращает (png или None, file_id или None); (None, None) — промах."""
+        with self._lock:
+            entry = self._index.get(key)
+            if not entry:
+                self.misses += 1
+                return None, None
+            self._index.move_to_end(key)
+            if entry['digest'] is not None:
+                self._sizes.move_to_end(entry['digest'])
+            self._schedule_flush()
+            if entry['file_id']:
+                self.hits += 1
+                return None, entry['file_id']
+            digest = entry['digest']
+        try:
+            with open(self._path(digest), 'rb') as f:
+                png = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                if self._index.get(key) is entry:
+                    self._drop(key)
+                self.misses += 1
+            return None, None
+        with self._lock:
+            self.hits += 1
+        return png, None
+
+    def put(self, key: str, png: bytes):
+        digest = hashlib.sha256(png).hexdigest()
+        path = self._path(digest)
+        # Файл пишется вне блокировки; под ней — только подмена и учет
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(png)
+        with self._lock:
+            if digest in self._sizes:
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+            self._add_entry(key, {'digest': digest, 'file_id': None}, {digest: len(png)})
+            self._evict()
+            self._schedule_flush()
+
+    def set_file_id(self, key: str, file_id: str):
+        with self._lock:
+            if key in self._index:
+                self._index[key]['file_id'] = file_id
+                self._schedule_flush()
+
+    def clear(self):
+        with self._lock:
+            digests = list(self._sizes)
+            self._index = OrderedDict()
+            self._sizes = OrderedDict()
+            self._keys = {}
+            self._versions = {}
+            self._bytes = 0
+            for digest in digests:
+                self._remove_file(digest)
+            self._schedule_flush()
+        self.flush()
+
+    def stop(self):
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._index), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,114 @@
+# charts.py
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+CHART_WORKERS = int(os.environ.get('CHART_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Сколько графиков может ждать очереди сверх числа процессов
+CHART_QUEUE_LIMIT = int(os.environ.get('CHART_QUEUE_LIMIT', '32'))
+
+
+def render_chart_png(labels, morning_data, evening_data, title, morning_color, evening_color) -> bytes:
+    """
+    Рисует график пикфлоуметрии за месяц и возвращает PNG.
+    Выполняется в отдельном процессе, поэтому использует только объектный API
+    Figure без глобального состояния pyplot.
+    """
+    fig = Figure(figsize=(18, 8))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+
+    ax.plot(labels, morning_data, label='Утро', color=morning_color, marker='o', linestyle='-', markersize=8, mfc='white')
+    ax.plot(labels, evening_data, label='Вечер', color=evening_color, marker='o', linestyle='-', markersize=8, mfc='white')
+
+    for i, val in enumerate(morning_data):
+        if val is not None: ax.annotate(str(val), (labels[i], val), textcoords="offset points", xytext=(0,10), ha='center')
+    for i, val in enumerate(evening_data):
+        if val is not None: ax.annotate(str(val), (labels[i], val), textcoords="offset points", xytext=(0,-20), ha='center')
+
+    ax.set_xlabel('День месяца')
+    ax.set_ylabel('Пикфлоуметр (л/мин)')
+    ax.set_title(title)
+    ax.set_xticks(labels)
+    ax.set_ylim(50, 500)
+    ax.set_yticks(range(50, 501, 50))
+    ax.grid(True, linestyle='--', alpha=0.6)
+    ax.legend()
+    fig.tight_layout()
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=150)
+    return buf.getvalue()
+
+
+class ChartRenderer:
+    """
+    Пул процессов для отрисовки графиков: matplotlib нагружает CPU и не должен
+    останавливать цикл событий. Число одновременно ожидающих и выполняемых
+    задач ограничено, глубина очереди доступна для метрик.
+    """
+
+    def __init__(self, max_workers=CHART_WORKERS, queue_limit=CHART_QUEUE_LIMIT):
+        self.max_workers = max_workers
+        self._executor = None
+        self._slots = None
+        self._capacity = max_workers + queue_limit
+        self.waiting = 0
+        self.in_pool = 0
+        self.rendered = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        if self._executor is None:
+            # spawn: дочерние процессы не наследуют потоки и сокеты бота
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+            self._slots = asyncio.Semaphore(self._capacity)
+
+    async def render(self, *args) -> bytes:
+        self._ensure_started()
+        # Сверх лимита задачи ждут здесь, не занимая очередь пула процессов
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_pool += 1
+        try:
+            loop = asyncio.get_running_loop()
+            png = await loop.run_in_executor(self._executor, render_chart_png, *args)
+            self.rendered += 1
+            return png
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_pool -= 1
+            self._slots.release()
+
+    @property
+    def queue_depth(self) -> int:
+        """Графики, ожидающие или выполняющиеся в пуле."""
+        return self.waiting + self.in_pool
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.max_workers,
+            'waiting': self.waiting,
+            'in_pool': self.in_pool,
+            'queue_depth': self.queue_depth,
+            'rendered': self.rendered,
+            'failed': self.failed,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,159 @@
+# context_builder.py
+import math
+import re
+import threading
+from collections import OrderedDict
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+# Средняя длина токена: латиница кодируется экономнее кириллицы
+_CHARS_PER_TOKEN_LATIN = 4.0
+_CHARS_PER_TOKEN_OTHER = 2.5
+# Служебные токены на каждое сообщение истории (роль, разделители)
+_MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая локальная оценка числа токенов без обращения к API."""
+    tokens = 0
+    for piece in _TOKEN_RE.findall(text or ""):
+        per_token = _CHARS_PER_TOKEN_LATIN if piece.isascii() else _CHARS_PER_TOKEN_OTHER
+        tokens += max(1, math.ceil(len(piece) / per_token))
+    return tokens
+
+
+class SummaryStore:
+    """Краткие содержания старых частей диалога: Postgres + LRU в памяти."""
+
+    def __init__(self, db_pool, max_entries=10000):
+        self.db_pool = db_pool
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Возвращает (summary, covered_until) или None, если краткого содержания еще нет."""
+        with self._lock:
+            if user_id in self._entries:
+                self._entries.move_to_end(user_id)
+                return self._entries[user_id]
+        with self.db_pool.connection("load_summary") as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT summary, covered_until FROM chat_summaries WHERE user_id = %s;",
+                    (user_id,),
+                )
+                row = cur.fetchone()
+        self._remember(user_id, tuple(row) if row else None)
+        return row and tuple(row)
+
+    def save(self, user_id, summary, covered_until):
+        with self.db_pool.connection("save_summary") as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO chat_summaries (user_id, summary, covered_until, updated_at)
+                    VALUES (%s, %s, %s, NOW())
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET summary = EXCLUDED.summary,
+                        covered_until = EXCLUDED.covered_until,
+                        updated_at = EXCLUDED.updated_at;
+                """, (user_id, summary, covered_until))
+        self._remember(user_id, (summary, covered_until))
+
+    def _remember(self, user_id, value):
+        with self._lock:
+            self._entries[user_id] = value
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class ContextBuilder:
+    """
+    Собирает историю для Gemini в пределах бюджета токенов.
+    Свежие сообщения идут как есть, более старые сворачиваются
+    в краткое содержание, которое обновляется инкрементально. Чтобы не
+    тратить вызов Gemini на каждый ход, свертка запускается, только когда
+    накопилось не меньше summarize_messages сообщений или summarize_tokens
+    токенов (по умолчанию — половина окна или бюджета).
+    """
+
+    def __init__(self, summary_store, model, token_budget=3000, max_messages=20,
+                 summarize_messages=None, summarize_tokens=None):
+        self.summary_store = summary_store
+        self.model = model
+        self.token_budget = token_budget
+        self.max_messages = max_messages
+        self.summarize_messages = summarize_messages or max(1, max_messages // 2)
+        self.summarize_tokens = summarize_tokens or max(1, token_budget // 2)
+        self._summarizing = set()
+
+    def _summary_due(self, overflow) -> bool:
+        if len(overflow) >= self.summarize_messages:
+            return True
+        return sum(estimate_tokens(row[1]) + _MESSAGE_OVERHEAD for row in overflow) >= self.summarize_tokens
+
+    def build(self, user_id, rows, user_text=""):
+        """
+        rows — строки (role, content, timestamp) по возрастанию времени.
+        Возвращает историю для start_chat и строки, которые пора свернуть в краткое содержание
+        (пустой список, пока их меньше порога: до свертки они просто не попадают в контекст).
+        """
+        stored = self.summary_store.get(user_id)
+        summary, covered_until = stored if stored else (None, None)
+        if covered_until is not None:
+            rows = [row for row in rows if row[2] > covered_until]
+
+        budget = self.token_budget - estimate_tokens(user_text) - _MESSAGE_OVERHEAD
+        if summary:
+            budget -= estimate_tokens(summary) + 2 * _MESSAGE_OVERHEAD
+
+        kept = []
+        for row in reversed(rows):
+            cost = estimate_tokens(row[1]) + _MESSAGE_OVERHEAD
+            if cost > budget or len(kept) >= self.max_messages:
+                break
+            budget -= cost
+            kept.append(row)
+        kept.reverse()
+        # История для Gemini должна начинаться с реплики пользователя
+        while kept and kept[0][0] != 'user':
+            kept.pop(0)
+
+        overflow = rows[:len(rows) - len(kept)]
+        if not self._summary_due(overflow):
+            overflow = []
+        history = []
+        if summary:
+            history.append({"role": "user", "parts": [f"Краткое содержание нашего предыдущего разговора: {summary}"]})
+            history.append({"role": "model", "parts": ["Понял, учту это."]})
+        history.extend({"role": role, "parts": [content]} for role, content, _ in kept)
+        return history, overflow
+
+    async def summarize(self, user_id, overflow, run_db):
+        """
+        Дописывает в краткое содержание сообщения, не поместившиеся в бюджет.
+        run_db — корутина для выполнения блокирующих вызовов БД вне цикла событий.
+        """
+        if not overflow or user_id in self._summarizing:
+            return
+        self._summarizing.add(user_id)
+        try:
+            stored = await run_db(self.summary_store.get, user_id)
+            previous = stored[0] if stored else ""
+            dialogue = "\n".join(
+                f"{'Пользователь' if role == 'user' else 'Ассистент'}: {content}"
+                for role, content, _ in overflow
+            )
+            prompt = (
+                "Обнови краткое содержание диалога пользователя с ассистентом. "
+                "Сохрани факты, просьбы и договоренности, опусти мелочи. Не более 150 слов.\n\n"
+                f"Текущее краткое содержание: {previous or 'нет'}\n\n"
+                f"Новые сообщения:\n{dialogue}"
+            )
+            response = await self.model.generate_content_async(prompt)
+            await run_db(self.summary_store.save, user_id, response.text.strip(), overflow[-1][2])
+        except Exception as e:
+            print(f"Ошибка обновления краткого содержания для пользователя {user_id}: {e}")
+        finally:
+            self._summarizing.discard(user_id)
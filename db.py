@@ -0,0 +1,272 @@
+# db.py
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extras, pool as pg_pool
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведенное время."""
+
+
+class ConnectionPool:
+    """
+    Ограниченный пул соединений PostgreSQL.
+    Проверяет соединения перед выдачей, переподключается при сбоях
+    и собирает метрики выдачи соединений по каждому вызову.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, checkout_timeout=10.0,
+                 health_check_interval=30.0, connect_retries=3, retry_delay=0.5):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.connect_retries = connect_retries
+        self.retry_delay = retry_delay
+
+        self._pool = None
+        self._lock = threading.Lock()
+        # Семафор ограничивает число одновременно выданных соединений:
+        # при исчерпании пула вызов ждет, а не падает с PoolError.
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_checked = {}
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+        self._in_use = 0
+        self._reconnects = 0
+
+    # --- Создание и прогрев ---
+
+    def _ensure_pool(self):
+        if self._pool is not None:
+            return self._pool
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._with_retries(
+                    lambda: pg_pool.ThreadedConnectionPool(self.minconn, self.maxconn, self.dsn)
+                )
+        return self._pool
+
+    def _with_retries(self, factory):
+        last_error = None
+        for attempt in range(self.connect_retries):
+            try:
+                return factory()
+            except psycopg2.OperationalError as e:
+                last_error = e
+                print(f"Ошибка подключения к базе данных (попытка {attempt + 1}): {e}")
+                time.sleep(self.retry_delay * (2 ** attempt))
+        raise last_error
+
+    def warm(self):
+        """Открывает minconn соединений заранее, чтобы первый запрос не ждал рукопожатия."""
+        pool = self._ensure_pool()
+        conns = []
+        try:
+            for _ in range(self.minconn):
+                conns.append(pool.getconn())
+        finally:
+            for conn in conns:
+                pool.putconn(conn)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+            self._last_checked.clear()
+
+    # --- Проверка здоровья ---
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last = self._last_checked.get(id(conn), 0)
+        if time.monotonic() - last < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            self._last_checked[id(conn)] = time.monotonic()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def _checkout(self):
+        pool = self._ensure_pool()
+        for attempt in range(self.connect_retries):
+            try:
+                conn = pool.getconn()
+            except psycopg2.OperationalError as e:
+                print(f"Ошибка подключения к базе данных (попытка {attempt + 1}): {e}")
+                time.sleep(self.retry_delay * (2 ** attempt))
+                continue
+            if self._is_healthy(conn):
+                return conn
+            # Соединение оборвалось (рестарт БД, таймаут простоя) — выбрасываем и берем новое
+            self._discard(pool, conn)
+            with self._stats_lock:
+                self._reconnects += 1
+        raise psycopg2.OperationalError("Не удалось получить рабочее соединение с базой данных.")
+
+    def _discard(self, pool, conn):
+        self._last_checked.pop(id(conn), None)
+        try:
+            pool.putconn(conn, close=True)
+        except pg_pool.PoolError:
+            pass
+
+    # --- Выдача соединений ---
+
+    @contextmanager
+    def connection(self, name="db"):
+        """
+        Выдает соединение из пула. При успешном выходе делает commit,
+        при исключении — rollback; оборванные соединения закрываются.
+        """
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            self._record(name, time.monotonic() - started, 0.0, failed=True)
+            raise PoolTimeout(f"Пул соединений исчерпан ({self.maxconn}), вызов {name}.")
+
+        conn = None
+        broken = False
+        failed = False
+        checked_out = started
+        try:
+            conn = self._checkout()
+            checked_out = time.monotonic()
+            with self._stats_lock:
+                self._in_use += 1
+            try:
+                yield conn
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                failed = broken = True
+                raise
+            except Exception:
+                failed = True
+                if not conn.closed:
+                    conn.rollback()
+                raise
+        except (psycopg2.OperationalError, PoolTimeout):
+            failed = True
+            raise
+        finally:
+            if conn is not None:
+                with self._stats_lock:
+                    self._in_use -= 1
+                pool = self._pool
+                if pool is not None:
+                    if broken or conn.closed:
+                        self._discard(pool, conn)
+                    else:
+                        pool.putconn(conn)
+            self._slots.release()
+            self._record(name, checked_out - started, time.monotonic() - checked_out, failed)
+
+    # --- Метрики ---
+
+    def _record(self, name, wait, hold, failed=False):
+        with self._stats_lock:
+            entry = self._stats.setdefault(name, {
+                'checkouts': 0, 'failures': 0,
+                'wait_total': 0.0, 'wait_max': 0.0,
+                'hold_total': 0.0, 'hold_max': 0.0,
+            })
+            entry['checkouts'] += 1
+            if failed:
+                entry['failures'] += 1
+            entry['wait_total'] += wait
+            entry['wait_max'] = max(entry['wait_max'], wait)
+            entry['hold_total'] += hold
+            entry['hold_max'] = max(entry['hold_max'], hold)
+
+    def stats(self) -> dict:
+        """Снимок метрик пула: занятые соединения, переподключения и статистика по вызовам."""
+        with self._stats_lock:
+            return {
+                'size': self.maxconn,
+                'in_use': self._in_use,
+                'reconnects': self._reconnects,
+                'calls': {name: dict(entry) for name, entry in self._stats.items()},
+            }
+
+
+class WriteBehindBuffer:
+    """
+    Буфер отложенной записи: строки копятся в памяти и пачкой
+    вставляются через execute_values в фоновом потоке.
+    """
+
+    def __init__(self, db_pool, insert_sql, flush_interval=1.0, max_batch=500, max_pending=10000):
+        self.db_pool = db_pool
+        self.insert_sql = insert_sql
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def add(self, row):
+        with self._lock:
+            if len(self._rows) >= self.max_pending:
+                print("Буфер отложенной записи переполнен, строка отброшена.")
+                return
+            self._rows.append(row)
+            size = len(self._rows)
+        if size >= self.max_batch:
+            self._wakeup.set()
+
+    def pending(self):
+        """Возвращает копию еще не записанных строк."""
+        with self._lock:
+            return list(self._rows)
+
+    def flush(self):
+        with self._flush_lock:
+            # Строки остаются видимыми в pending() до коммита, чтобы читатели
+            # не пропустили их в промежутке между буфером и базой.
+            with self._lock:
+                batch = self._rows[:self.max_batch * 10]
+            if not batch:
+                return 0
+            try:
+                with self.db_pool.connection("write_behind_flush") as conn:
+                    with conn.cursor() as cur:
+                        extras.execute_values(cur, self.insert_sql, batch, page_size=self.max_batch)
+            except Exception as e:
+                print(f"Ошибка пакетной записи ({len(batch)} строк): {e}")
+                return 0
+            with self._lock:
+                del self._rows[:len(batch)]
+            return len(batch)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval * 5)
+            self._thread = None
+        self.flush()
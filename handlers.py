@@ -1,26 +1,85 @@
 # handlers.py
+import asyncio
 import os
 from datetime import datetime, date, time, timezone, timedelta
 import json
 import google.generativeai as genai
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.constants import ParseMode 
+from telegram.error import RetryAfter
 from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, MessageHandler, filters
-import matplotlib.pyplot as plt
 import io
 import re
 import calendar
 
-from utils import load_json_with_firestore_sync, save_json_with_firestore_sync, get_sheet, calculate_age
+import utils
+from utils import get_sheet, calculate_age
+from aggregation import PROMPT_LEGEND, MonthStats, prompt_features, to_optional_ints
+from async_io import firestore_io, gemini_io, sheets_io, storage_io
+from broadcast import BROADCAST_RATE, DeliveryCheckpoint, MessageDispatcher, fan_out
+from chart_cache import ChartCache, chart_key
+from charts import ChartRenderer
+from measurement_log import MeasurementWriter
+from measurement_store import MeasurementStore
+from metrics import instrument_handler, register_stats, timed
+from rate_limit import TokenBucket
+from reminder_scheduler import ReminderSchedule
+from report_cache import ReportCache, report_digest
+from state_cache import ChatDocumentStore, Profile, Reminder, StateCache
+from streaming import STREAM_ENABLED, gemini_text_chunks, require_text, stream_reply
 
 # --- НАСТРОЙКА ---
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 PROFILES_FILE = "profiles.json"
 REMINDERS_FILE = "reminders.json"
 CHARTS_SENT_FILE = "charts_sent.json"
+REMINDER_TEXT = "На незабудке сделать замер! 🌸"
 
+MEASUREMENT_RETRY_SECONDS = 60
+
+# Одна модель на процесс: клиент и его HTTP-соединения переиспользуются
+report_model = None
 if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
+    report_model = genai.GenerativeModel('gemini-1.5-flash-latest')
+# Готовые ИИ-отчеты по (chat_id, хэш входных данных)
+report_cache = ReportCache()
+
+chart_renderer = ChartRenderer()
+# Готовые графики по (chat_id, месяц, версия данных) и их file_id в Telegram
+chart_cache = ChartCache()
+
+# Профили и напоминания в памяти: читаются один раз, изменения пишутся сразу
+profile_state = StateCache(PROFILES_FILE, Profile)
+reminder_state = StateCache(REMINDERS_FILE, Reminder)
+# Отметки об отправленных ежемесячных графиках, документ на чат
+charts_sent_store = ChatDocumentStore(CHARTS_SENT_FILE)
+
+def load_charts_sent() -> dict:
+    # До переноса в документы по чатам значением был сам список месяцев
+    return {
+        chat_id: value.get('months', []) if isinstance(value, dict) else value
+        for chat_id, value in charts_sent_store.load_all().items()
+    }
+
+# Локальная копия листа замеров: все чтения идут в нее, а не в Google Sheets
+measurement_store = MeasurementStore()
+measurement_writer = MeasurementWriter(get_sheet, on_append=measurement_store.add_rows)
+
+async def sync_measurements() -> bool:
+    """Догружает новые строки листа в локальную копию, не блокируя цикл событий."""
+    try:
+        return await sheets_io.run(measurement_store.sync_if_stale, get_sheet)
+    except asyncio.TimeoutError:
+        return False
+
+async def load_measurements(chat_id, start: date, end: date) -> list:
+    """Замеры чата за период из локальной копии, предварительно догрузив новые строки листа."""
+    await sync_measurements()
+    return await storage_io.run(measurement_store.query, chat_id, start, end)
+
+def month_bounds(year: int, month: int) -> tuple:
+    return date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1])
 
 # Состояния диалогов
 (
@@ -36,30 +95,31 @@ async def show_main_menu(update: Update, text: str):
 
 async def check_setup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     chat_id = str(update.effective_chat.id)
-    profiles = load_json_with_firestore_sync(PROFILES_FILE, telegram_chat_id="global_data")
-    reminders = load_json_with_firestore_sync(REMINDERS_FILE, telegram_chat_id="global_data")
-    user_profile = profiles.get(chat_id)
+    user_profile = profile_state.get(chat_id)
 
-    if not user_profile or not user_profile.get('dob') or not user_profile.get('sex'):
+    if not user_profile or not user_profile.is_complete:
         await update.effective_message.reply_text("Сначала нужно настроить профиль! Пожалуйста, используйте команду /profile.", reply_markup=ReplyKeyboardRemove())
         return False
 
-    if chat_id not in reminders:
+    if chat_id not in reminder_state:
         await update.effective_message.reply_text("Отлично! Профиль настроен. Теперь нужно настроить напоминания. Используйте команду /remind.", reply_markup=ReplyKeyboardRemove())
         return False 
     return True
 
+@instrument_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data.clear()
     await show_main_menu(update, "Действие отменено.")
     return ConversationHandler.END
 
 # --- Функции-обработчики ---
+@instrument_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_setup(update, context):
         return
     await show_main_menu(update, f'Привет, {update.effective_user.first_name}! Я помощник Бронхитик.')
 
+@instrument_handler
 async def start_logging(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not await check_setup(update, context):
         return ConversationHandler.END
@@ -67,6 +127,7 @@ async def start_logging(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     await update.message.reply_text("Давай запишем показания. Какое число показал прибор?", reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True, one_time_keyboard=True))
     return GET_PEAKFLOW
 
+@instrument_handler
 async def get_peakflow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.text == "Отмена": return await cancel(update, context)
     try:
@@ -78,6 +139,7 @@ async def get_peakflow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         await update.message.reply_text("Это не похоже на число. Попробуй еще раз.")
         return GET_PEAKFLOW 
 
+@instrument_handler
 async def get_breathing(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.text == "Отмена": return await cancel(update, context)
     context.user_data['breathing'] = update.message.text
@@ -85,6 +147,7 @@ async def get_breathing(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     await update.message.reply_text("А кашель был?", reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
     return GET_COUGH
 
+@instrument_handler
 async def get_cough(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.text == "Отмена": return await cancel(update, context)
     context.user_data['cough'] = update.message.text
@@ -92,6 +155,7 @@ async def get_cough(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text("Мокрота была?", reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
     return GET_SPUTUM
 
+@instrument_handler
 async def get_sputum(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.text == "Отмена": return await cancel(update, context)
     context.user_data['sputum'] = update.message.text
@@ -99,55 +163,64 @@ async def get_sputum(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text("Какие-то лекарства принимал(а)?", reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
     return GET_MEDS
 
+@instrument_handler
 async def get_meds_and_save(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.text == "Отмена": return await cancel(update, context)
     context.user_data['meds'] = update.message.text
     await update.message.reply_text("Спасибо! Сейчас все запишу...")
 
     chat_id = str(update.effective_chat.id)
-    profiles = load_json_with_firestore_sync(PROFILES_FILE, telegram_chat_id="global_data")
-    user_profile = profiles.get(chat_id, {})
-    dob_str = user_profile.get('dob')
-    sex = user_profile.get('sex', 'н/д')
+    user_profile = profile_state.get(chat_id) or Profile()
+    dob_str = user_profile.dob
+    sex = user_profile.sex or 'н/д'
     age = calculate_age(dob_str) if dob_str else 'н/д'
 
-    sheet = get_sheet()
-    if not sheet:
-        await show_main_menu(update, "❌ Ошибка! Не смог подключиться к таблице.")
-        return ConversationHandler.END
-
-    try:
-        all_records = sheet.get_all_records()
-        next_record_number = len(all_records) + 1
-    except Exception as e:
-        print(f"Ошибка получения записей из таблицы: {e}")
-        all_records = []
-        next_record_number = 1
-
     now_moscow = datetime.now(timezone(timedelta(hours=3)))
     measurement_type = "утро" if now_moscow.hour < 15 else "вечер"
 
+    # Номер записи проставит measurement_writer при отправке в таблицу
     row_to_save = [
-        next_record_number, now_moscow.strftime("%d.%m.%Y"), now_moscow.strftime("%H:%M:%S"),
+        now_moscow.strftime("%d.%m.%Y"), now_moscow.strftime("%H:%M:%S"),
         measurement_type, context.user_data.get('peakflow'), context.user_data.get('breathing'),
         context.user_data.get('cough'), context.user_data.get('sputum'), context.user_data.get('meds'),
-        age, sex
+        age, sex, chat_id
     ]
     try:
-        sheet.append_row(row_to_save, value_input_option='USER_ENTERED')
+        appended = await sheets_io.run(measurement_writer.append, row_to_save)
+    except asyncio.TimeoutError:
+        # Строка уже в журнале, а запись в таблицу может еще завершиться сама
+        appended = False
+    # Отчет ИИ по старым данным больше не актуален
+    report_cache.invalidate(chat_id)
+    if appended:
         await show_main_menu(update, "✅ Готово! Все записала. Молодец!")
-    except Exception as e:
-        print(f"Ошибка записи в Google Sheets: {e}")
-        await show_main_menu(update, "❌ Ой, не смогла сохранить данные.")
+    else:
+        # Строка осталась в локальном журнале; повторим отправку позже
+        schedule_measurement_retry(context.job_queue)
+        await show_main_menu(update, "✅ Записала! Таблица сейчас недоступна, данные отправятся в нее чуть позже.")
 
     context.user_data.clear()
     return ConversationHandler.END
 
+def schedule_measurement_retry(job_queue):
+    if not job_queue.get_jobs_by_name("measurement_retry"):
+        job_queue.run_once(retry_measurement_queue, MEASUREMENT_RETRY_SECONDS, name="measurement_retry")
+
+async def retry_measurement_queue(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        flushed = await sheets_io.run(measurement_writer.flush)
+    except asyncio.TimeoutError:
+        flushed = False
+    if not flushed:
+        schedule_measurement_retry(context.job_queue)
+
+@instrument_handler
 async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     reply_keyboard = [["Отмена"]]
     await update.message.reply_text("Давайте настроим профиль. Введите дату рождения ребенка (ДД.ММ.ГГГГ).", reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True, one_time_keyboard=True))
     return SET_PROFILE
 
+@instrument_handler
 async def set_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.text == "Отмена": return await cancel(update, context)
     try:
@@ -161,6 +234,7 @@ async def set_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         await update.message.reply_text("Неверный формат. Попробуйте еще раз (ДД.ММ.ГГГГ).")
         return SET_PROFILE
 
+@instrument_handler
 async def get_gender(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.text == "Отмена": return await cancel(update, context)
     sex_raw = update.message.text.strip().lower()
@@ -173,17 +247,17 @@ async def get_gender(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return await profile_command(update, context)
     chat_id = str(update.effective_chat.id)
     first_name = update.effective_user.first_name
-    profiles = load_json_with_firestore_sync(PROFILES_FILE, telegram_chat_id="global_data")
-    profiles[chat_id] = {'dob': dob_str, 'sex': sex_raw, 'first_name': first_name}
-    save_json_with_firestore_sync(profiles, PROFILES_FILE, telegram_chat_id="global_data")
+    await firestore_io.run(profile_state.set, chat_id, Profile(dob=dob_str, sex=sex_raw, first_name=first_name))
     await update.message.reply_text("Профиль успешно сохранен! Теперь давайте настроим напоминания.")
     return await remind_command(update, context)
 
+@instrument_handler
 async def remind_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     reply_keyboard = [["Отмена"]]
     await update.message.reply_text("Введите время для напоминаний (например: 08:00 20:30).", reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True, one_time_keyboard=True))
     return SET_REMINDER
 
+@instrument_handler
 async def set_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.text == "Отмена": return await cancel(update, context)
     chat_id = str(update.message.chat_id)
@@ -192,19 +266,8 @@ async def set_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         if len(times) != 2: raise ValueError("Требуется два времени.")
         for t_str in times:
             datetime.strptime(t_str, '%H:%M')
-        reminders = load_json_with_firestore_sync(REMINDERS_FILE, telegram_chat_id="global_data")
-        if chat_id in reminders and 'jobs' in reminders.get(chat_id, {}):
-            for job_name in reminders[chat_id]['jobs']:
-                for job in context.job_queue.get_jobs_by_name(job_name):
-                    job.schedule_removal()
-        job_names = []
-        for i, t_str in enumerate(times):
-            t = datetime.strptime(t_str, '%H:%M').time()
-            job_name = f"reminder_{chat_id}_{i}"
-            job_names.append(job_name)
-            context.job_queue.run_daily(send_reminder, time=t.replace(tzinfo=timezone(timedelta(hours=3))), chat_id=int(chat_id), name=job_name)
-        reminders[chat_id] = {'times': times, 'jobs': job_names}
-        save_json_with_firestore_sync(reminders, REMINDERS_FILE, telegram_chat_id="global_data")
+        # Расписание обновится через подписку reminder_schedule на reminder_state
+        await firestore_io.run(reminder_state.set, chat_id, Reminder(times=times))
         await show_main_menu(update, "Отлично! Напоминания установлены. Теперь все готово к работе!")
         return ConversationHandler.END
     except Exception as e:
@@ -212,19 +275,24 @@ async def set_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         await update.message.reply_text("Неверный формат. Пожалуйста, введите два времени (например, 08:00 20:30).")
         return SET_REMINDER
 
-async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
-    await context.bot.send_message(chat_id=context.job.chat_id, text="На незабудке сделать замер! 🌸")
+async def forget_blocked_chat(chat_id):
+    # Бот заблокирован в чате: напоминания туда больше не отправляются
+    await firestore_io.run(reminder_state.delete, chat_id)
+
+# Напоминания из одной минуты уходят пачкой через общий и поминутный лимитеры
+reminder_dispatcher = MessageDispatcher(on_blocked=forget_blocked_chat)
 
+async def send_reminders(bot, chat_ids: list, scheduled_at: float = None):
+    await reminder_dispatcher.send_batch(bot, chat_ids, REMINDER_TEXT, scheduled_at)
+
+# Одна общая задача раз в минуту вместо двух ежедневных задач на пользователя
+reminder_schedule = ReminderSchedule(send_reminders)
+reminder_state.add_listener(reminder_schedule.update)
+
+@instrument_handler
 async def cancel_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = str(update.message.chat_id)
-    reminders = load_json_with_firestore_sync(REMINDERS_FILE, telegram_chat_id="global_data")
-    if chat_id in reminders:
-        if 'jobs' in reminders.get(chat_id, {}):
-            for job_name in reminders[chat_id]['jobs']:
-                for job in context.job_queue.get_jobs_by_name(job_name):
-                    job.schedule_removal()
-        del reminders[chat_id]
-        save_json_with_firestore_sync(reminders, REMINDERS_FILE, telegram_chat_id="global_data")
+    if await firestore_io.run(reminder_state.delete, chat_id):
         await update.message.reply_text("Все ваши напоминания отменены.")
     else:
         await update.message.reply_text("У вас нет активных напоминаний.")
@@ -237,109 +305,84 @@ def parse_rgb_string(rgb_string):
         return (r / 255, g / 255, b / 255)
     raise ValueError(f"Неверный формат RGB строки: {rgb_string}")
 
-async def _generate_chart_image(chat_id: int, user_first_name: str, sheet_records: list, target_year: int = None, target_month: int = None):
+async def _generate_chart_image(chat_id: int, user_first_name: str, records: list, target_year: int = None, target_month: int = None):
     today_date = date.today()
     current_year = target_year if target_year is not None else today_date.year
     current_month = target_month if target_month is not None else today_date.month
 
-    num_days_in_month = calendar.monthrange(current_year, current_month)[1]
-
-    daily_raw_data = {day: {'morning': [], 'evening': []} for day in range(1, num_days_in_month + 1)}
-
-    for record in sheet_records:
-        try:
-            record_date_str = record.get('Дата')
-            if not record_date_str: continue
-
-            record_datetime_obj = datetime.strptime(record_date_str, "%d.%m.%Y")
-
-            if record_datetime_obj.year == current_year and record_datetime_obj.month == current_month:
-                day = record_datetime_obj.day
-                value = int(record.get('Пикфлоуметр', 0))
-                time_of_day = record.get('Время суток', '').strip().lower()
-
-                if time_of_day == 'утро':
-                    daily_raw_data[day]['morning'].append(value)
-                elif time_of_day == 'вечер':
-                    daily_raw_data[day]['evening'].append(value)
-        except (ValueError, TypeError) as e:
-            print(f"Ошибка обработки записи для графика: {e}, Запись: {record}")
-            continue
-
-    labels = list(range(1, num_days_in_month + 1))
-    morning_data = [max(daily_raw_data[d]['morning']) if daily_raw_data[d]['morning'] else None for d in labels]
-    evening_data = [max(daily_raw_data[d]['evening']) if daily_raw_data[d]['evening'] else None for d in labels]
-
-    if not any(morning_data) and not any(evening_data):
+    # Группировка по дням и времени суток — один векторизованный проход
+    stats = MonthStats.from_records(records, current_year, current_month)
+    if not stats.has_data:
         return None
 
-    fig, ax = plt.subplots(figsize=(18, 8))
+    labels = stats.labels
+    morning_data = to_optional_ints(stats.morning_max)
+    evening_data = to_optional_ints(stats.evening_max)
 
     morning_color = parse_rgb_string('rgb(54, 162, 235)')
     evening_color = parse_rgb_string('rgb(255, 99, 132)')
+    title = f'Дневник пикфлоуметрии за {date(current_year, current_month, 1).strftime("%B %Y")}'
 
-    ax.plot(labels, morning_data, label='Утро', color=morning_color, marker='o', linestyle='-', markersize=8, mfc='white')
-    ax.plot(labels, evening_data, label='Вечер', color=evening_color, marker='o', linestyle='-', markersize=8, mfc='white')
-
-    for i, val in enumerate(morning_data):
-        if val is not None: ax.annotate(str(val), (labels[i], val), textcoords="offset points", xytext=(0,10), ha='center')
-    for i, val in enumerate(evening_data):
-        if val is not None: ax.annotate(str(val), (labels[i], val), textcoords="offset points", xytext=(0,-20), ha='center')
-
-    ax.set_xlabel('День месяца')
-    ax.set_ylabel('Пикфлоуметр (л/мин)')
-    ax.set_title(f'Дневник пикфлоуметрии за {date(current_year, current_month, 1).strftime("%B %Y")}')
-    ax.set_xticks(labels)
-    ax.set_ylim(50, 500)
-    ax.set_yticks(range(50, 501, 50))
-    ax.grid(True, linestyle='--', alpha=0.6)
-    ax.legend()
-    plt.tight_layout()
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=150)
-    buf.seek(0)
-    plt.close(fig)
-    return buf
+    # Отрисовка идет в пуле процессов, цикл событий тем временем обслуживает других
+    with timed('matplotlib', 'render'):
+        png = await chart_renderer.render(labels, morning_data, evening_data, title, morning_color, evening_color)
+    return io.BytesIO(png)
 
+async def _send_photo(bot, chat_id: int, photo, caption: str = None, limiter: TokenBucket = None):
+    for attempt in range(3):
+        if limiter:
+            await limiter.acquire()
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption)
+        except RetryAfter as e:
+            # Telegram просит подождать — притормаживаем всю рассылку, а не только этот чат
+            if limiter:
+                limiter.pause(e.retry_after)
+            else:
+                await asyncio.sleep(e.retry_after)
+            if attempt == 2:
+                raise
+
+async def send_month_chart(bot, chat_id: int, user_first_name: str, year: int, month: int, caption: str = None, limiter: TokenBucket = None) -> bool:
+    """
+    Отправляет график за месяц, по возможности без отрисовки: сначала по file_id
+    из кэша, затем готовым PNG, и только при промахе рисует заново.
+    Возвращает False, если за месяц нет данных.
+    """
+    version = await storage_io.run(measurement_store.month_version, chat_id, year, month)
+    key = chart_key(chat_id, year, month, version)
+    png, file_id = await storage_io.run(chart_cache.get, key)
+    if file_id:
+        await _send_photo(bot, chat_id, file_id, caption, limiter)
+        return True
+    if png is None:
+        records = await storage_io.run(measurement_store.query, chat_id, *month_bounds(year, month))
+        chart_image_buffer = await _generate_chart_image(chat_id, user_first_name, records, year, month)
+        if not chart_image_buffer:
+            return False
+        png = chart_image_buffer.getvalue()
+        await storage_io.run(chart_cache.put, key, png)
+    message = await _send_photo(bot, chat_id, png, caption, limiter)
+    if message and message.photo:
+        await storage_io.run(chart_cache.set_file_id, key, message.photo[-1].file_id)
+    return True
+
+@instrument_handler
 async def chart_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not await check_setup(update, context):
         return ConversationHandler.END
 
     await update.message.reply_text("Собираю данные для выбора периода...")
 
-    sheet = get_sheet()
-    if not sheet:
+    if not await sync_measurements() and await storage_io.run(lambda: measurement_store.last_synced_row) <= 1:
         await show_main_menu(update, "❌ Не могу получить доступ к данным.")
         return ConversationHandler.END
 
-    try:
-        all_records = sheet.get_all_records()
-        if not all_records:
-            await show_main_menu(update, "В таблице пока нет данных для построения графика.")
-            return ConversationHandler.END
-    except Exception as e:
-        print(f"Ошибка получения записей из таблицы для графика: {e}")
-        await show_main_menu(update, "❌ Произошла ошибка при чтении данных из таблицы.")
-        return ConversationHandler.END
-
-    available_months = set()
-    for record in all_records:
-        date_str = record.get('Дата')
-        if date_str:
-            try:
-                dt_obj = datetime.strptime(date_str, "%d.%m.%Y")
-                month_key = dt_obj.strftime("%Y-%m")
-                available_months.add(month_key)
-            except ValueError:
-                continue
-
+    available_months = await storage_io.run(measurement_store.months, update.effective_chat.id)
     if not available_months:
-        await show_main_menu(update, "Не нашла данных с корректными датами для построения графика.")
+        await show_main_menu(update, "В таблице пока нет данных для построения графика.")
         return ConversationHandler.END
 
-    sorted_months = sorted(list(available_months), reverse=True)
-
     month_names = {
         "01": "Январь", "02": "Февраль", "03": "Март", "04": "Апрель",
         "05": "Май", "06": "Июнь", "07": "Июль", "08": "Август",
@@ -347,9 +390,8 @@ async def chart_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     }
 
     keyboard_buttons = []
-    for month_key in sorted_months:
-        year, month_num = month_key.split('-')
-        month_name = month_names.get(month_num, "")
+    for year, month in available_months:
+        month_name = month_names.get(f"{month:02d}", "")
         display_text = f"{month_name} {year}"
         keyboard_buttons.append([display_text])
 
@@ -360,6 +402,7 @@ async def chart_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
     return GET_CHART_MONTH
 
+@instrument_handler
 async def generate_chart_for_month(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.text == "Отмена":
         return await cancel(update, context)
@@ -385,28 +428,19 @@ async def generate_chart_for_month(update: Update, context: ContextTypes.DEFAULT
 
     await update.message.reply_text(f"Готовлю график за {selected_month_str}...")
 
-    sheet = get_sheet()
-    if not sheet:
-        await show_main_menu(update, "❌ Не могу получить доступ к данным.")
-        return ConversationHandler.END
-
-    all_records = sheet.get_all_records()
     user_first_name = update.effective_user.first_name or "Пользователь"
     chat_id = update.effective_chat.id
 
-    chart_image_buffer = await _generate_chart_image(
-        chat_id, user_first_name, all_records, target_year, target_month
-    )
-
-    if chart_image_buffer:
-        try:
-            await context.bot.send_photo(chat_id=chat_id, photo=chart_image_buffer)
+    try:
+        await sync_measurements()
+        sent = await send_month_chart(context.bot, chat_id, user_first_name, target_year, target_month)
+        if sent:
             await show_main_menu(update, "Вот твой график!")
-        except Exception as e:
-            print(f"Ошибка отправки графика: {e}")
-            await show_main_menu(update, "❌ Не удалось отправить график.")
-    else:
-        await show_main_menu(update, f"Нет данных за {selected_month_str} для построения графика.")
+        else:
+            await show_main_menu(update, f"Нет данных за {selected_month_str} для построения графика.")
+    except Exception as e:
+        print(f"Ошибка отправки графика: {e}")
+        await show_main_menu(update, "❌ Не удалось отправить график.")
 
     return ConversationHandler.END
 
@@ -418,39 +452,41 @@ async def send_monthly_chart_to_users(context: ContextTypes.DEFAULT_TYPE):
     last_day_of_previous_month = first_day_of_current_month - timedelta(days=1)
     target_year = last_day_of_previous_month.year
     target_month = last_day_of_previous_month.month
+    month_key = f"{target_year}-{target_month:02d}"
+    month_title = date(target_year, target_month, 1).strftime('%B %Y')
 
-    charts_sent_data = load_json_with_firestore_sync(CHARTS_SENT_FILE, telegram_chat_id="global_data")
-    all_profiles_data = load_json_with_firestore_sync(PROFILES_FILE, telegram_chat_id="global_data")
-    sheet = get_sheet()
-    if not sheet: return
-
-    all_records_from_sheet = sheet.get_all_records()
-
-    for chat_id_str, profile_data in all_profiles_data.items():
-        month_key = f"{target_year}-{target_month:02d}"
-        if month_key in charts_sent_data.get(chat_id_str, []):
-            continue
-
-        user_first_name = profile_data.get('first_name', 'Пользователь')
-        chart_image_buffer = await _generate_chart_image(
-            int(chat_id_str), user_first_name, all_records_from_sheet, target_year, target_month
-        )
-
-        if chart_image_buffer:
-            try:
-                await context.bot.send_photo(
-                    chat_id=int(chat_id_str),
-                    photo=chart_image_buffer,
-                    caption=f"Привет, {user_first_name}! Вот твой дневник за {date(target_year, target_month, 1).strftime('%B %Y')}."
-                )
-                if chat_id_str not in charts_sent_data:
-                    charts_sent_data[chat_id_str] = []
-                charts_sent_data[chat_id_str].append(month_key)
-            except Exception as e:
-                print(f"Ошибка отправки ежемесячного графика пользователю {chat_id_str}: {e}")
-
-    save_json_with_firestore_sync(charts_sent_data, CHARTS_SENT_FILE, telegram_chat_id="global_data")
+    # Доставка отмечается сразу после отправки, поэтому после падения прогон продолжится с места остановки
+    checkpoint = DeliveryCheckpoint(
+        load=load_charts_sent,
+        save=lambda changed: charts_sent_store.put_many({chat_id: {'months': months} for chat_id, months in changed.items()}),
+    )
+    await firestore_io.run(checkpoint.load)
+    await sync_measurements()
+    limiter = TokenBucket(BROADCAST_RATE)
+
+    async def deliver(item):
+        chat_id_str, profile = item
+        user_first_name = profile.first_name or 'Пользователь'
+        try:
+            sent = await send_month_chart(
+                context.bot, int(chat_id_str), user_first_name, target_year, target_month,
+                caption=f"Привет, {user_first_name}! Вот твой дневник за {month_title}.",
+                limiter=limiter,
+            )
+            if sent:
+                await firestore_io.run(checkpoint.mark, chat_id_str, month_key)
+        except Exception as e:
+            print(f"Ошибка отправки ежемесячного графика пользователю {chat_id_str}: {e}")
 
+    pending = [
+        (chat_id_str, profile) for chat_id_str, profile in profile_state.items()
+        if not checkpoint.is_done(chat_id_str, month_key)
+    ]
+    # Графики рисуются параллельно в пуле процессов, отправка идет через общий лимитер
+    await fan_out(pending, deliver)
+    await firestore_io.run(checkpoint.finish)
+
+@instrument_handler
 async def ai_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_setup(update, context): return
 
@@ -460,62 +496,86 @@ async def ai_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text("🤖 Минутку, отправляю данные на анализ Искусственному Интеллекту...")
 
-    sheet = get_sheet()
-    if not sheet:
-        await show_main_menu(update, "❌ Не могу получить доступ к данным.")
-        return
-
-    all_records = sheet.get_all_records()
-    two_weeks_ago = datetime.now() - timedelta(days=14)
-    recent_data = [
-        rec for rec in all_records
-        if 'Дата' in rec and rec.get('Дата') and datetime.strptime(rec['Дата'], "%d.%m.%Y") >= two_weeks_ago
-    ]
-
-    if not recent_data:
+    today = date.today()
+    start = today - timedelta(days=14)
+    records = await load_measurements(update.effective_chat.id, start, today)
+    if not records:
         await show_main_menu(update, "Недостаточно данных за последние 2 недели для анализа.")
         return
 
+    # Признаки окна вместо сырых строк: таблица по дням и готовая сводка
+    features = prompt_features(records, start, today)
+
     chat_id = str(update.effective_chat.id)
-    profiles = load_json_with_firestore_sync(PROFILES_FILE, telegram_chat_id="global_data")
-    user_profile = profiles.get(chat_id, {})
-    age = calculate_age(user_profile.get('dob')) if user_profile.get('dob') else 'не указан'
-    sex = user_profile.get('sex', 'н/д')
+    user_profile = profile_state.get(chat_id) or Profile()
+    age = calculate_age(user_profile.dob) if user_profile.dob else 'не указан'
+    sex = user_profile.sex or 'н/д'
 
-    initial_prompt = f"""Ты — заботливый ИИ-врач, ассистент по имени Бронхитик. Проанализируй данные из дневника здоровья ребенка. Профиль ребенка: возраст {age}, пол {sex}. Данные за последние две недели: {str(recent_data)}. Твоя задача: 1. Кратко оцени общую динамику пикфлоуметрии (стабильная, падает, растет). Обрати внимание на разницу между утром и вечером. 2. Посмотри, есть ли дни с низкими показателями. Если есть, проверь, были ли в эти дни симптомы (кашель, затрудненное дыхание). 3. Сформулируй выводы в 2-3 коротких и понятных предложениях. 4. Дай одну главную, ободряющую рекомендацию. Пиши в дружелюбной и поддерживающей манере, обращаясь к родителю."""
+    initial_prompt = f"""Ты — заботливый ИИ-врач, ассистент по имени Бронхитик. Проанализируй данные из дневника здоровья ребенка. Профиль ребенка: возраст {age}, пол {sex}. Дневник за последние две недели (пикфлоуметр в л/мин, по дням — максимум за утро и вечер). {PROMPT_LEGEND}\n{features}\nТвоя задача: 1. Кратко оцени общую динамику пикфлоуметрии (стабильная, падает, растет). Обрати внимание на разницу между утром и вечером. 2. Посмотри, есть ли дни с низкими показателями. Если есть, проверь, были ли в эти дни симптомы (кашель, затрудненное дыхание). 3. Сформулируй выводы в 2-3 коротких и понятных предложениях. 4. Дай одну главную, ободряющую рекомендацию. Пиши в дружелюбной и поддерживающей манере, обращаясь к родителю."""
 
-    try:
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        response = model.generate_content(initial_prompt)
+    async def stream_report() -> str:
+        response = await report_model.generate_content_async(initial_prompt, stream=True)
+        return await stream_reply(update.message, gemini_text_chunks(response), reply_markup=ReplyKeyboardRemove())
 
-        await update.message.reply_text(response.text, reply_markup=ReplyKeyboardRemove())
+    async def generate() -> str:
+        if STREAM_ENABLED:
+            # Таймаут и слот Gemini действуют на весь поток, а не только на его открытие
+            return await gemini_io.call(stream_report)
+        response = await gemini_io.call(report_model.generate_content_async, initial_prompt)
+        text = require_text(response.text)
+        await update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
+        return text
+
+    try:
+        # Те же данные — тот же отчет: повторный запрос не идет в Gemini
+        text, produced = await report_cache.get_or_run(chat_id, report_digest(initial_prompt), generate)
+        if not produced:
+            await update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
         await show_main_menu(update, "ИИ-анализ завершен.")
     except Exception as e:
         print(f"Ошибка Gemini API: {e}")
         await show_main_menu(update, "❌ Не удалось получить ответ от ИИ. Попробуйте позже.")
 
+@instrument_handler
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     text = update.message.text
     if text == "🤖 Анализ ИИ":
         await ai_report(update, context)
     return ConversationHandler.END
 
+@instrument_handler
 async def clear_data_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     reply_keyboard = [["Да", "Нет"], ["Отмена"]]
     await update.message.reply_text("ВНИМАНИЕ! Вы собираетесь полностью удалить все данные. Это действие необратимо. Вы уверены?", reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
     return CONFIRM_CLEAR_DATA
 
+def clear_sheet():
+    sheet = get_sheet()
+    if not sheet:
+        return
+    # row_count переиспользуемого листа устаревает после append_rows — размер сетки перечитываем
+    metadata = sheet.spreadsheet.fetch_sheet_metadata()
+    row_count = next(
+        item['properties']['gridProperties']['rowCount']
+        for item in metadata['sheets'] if item['properties']['sheetId'] == sheet.id
+    )
+    if row_count > 1:
+        sheet.delete_rows(2, row_count)
+
+@instrument_handler
 async def confirm_clear_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     response = update.message.text.lower()
     if response == "да":
         await update.message.reply_text("Начинаю очистку данных...")
         try:
-            sheet = get_sheet()
-            if sheet and sheet.row_count > 1:
-                sheet.delete_rows(2, sheet.row_count)
-            save_json_with_firestore_sync({}, PROFILES_FILE, telegram_chat_id="global_data")
-            save_json_with_firestore_sync({}, REMINDERS_FILE, telegram_chat_id="global_data")
-            save_json_with_firestore_sync({}, CHARTS_SENT_FILE, telegram_chat_id="global_data")
+            await sheets_io.run(clear_sheet)
+            measurement_writer.reset()
+            await storage_io.run(measurement_store.reset)
+            await storage_io.run(chart_cache.clear)
+            report_cache.clear()
+            await firestore_io.run(profile_state.clear)
+            await firestore_io.run(reminder_state.clear)
+            await firestore_io.run(charts_sent_store.clear)
             await update.message.reply_text("✅ Все данные успешно очищены! Теперь давайте настроим ваш профиль.")
             return await profile_command(update, context)
         except Exception as e:
@@ -527,6 +587,51 @@ async def confirm_clear_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text("Пожалуйста, ответьте 'Да' или 'Нет'.")
     return CONFIRM_CLEAR_DATA
 
+# --- Запуск ---
+async def sheets_ready() -> bool:
+    return await sheets_io.run(lambda: get_sheet() is not None)
+
+def ping_firestore() -> bool:
+    collection = utils.firestore_collection(PROFILES_FILE)
+    if collection is None:
+        return False
+    list(collection.limit(1).stream())
+    return True
+
+async def firestore_ready() -> bool:
+    return await firestore_io.run(ping_firestore)
+
+# Показатели пулов, кэшей и очередей для /metrics (keep_alive.build_web_app)
+register_stats('chart_renderer', chart_renderer.stats)
+register_stats('chart_cache', chart_cache.stats)
+register_stats('report_cache', report_cache.stats)
+register_stats('reminder_dispatcher', reminder_dispatcher.stats)
+register_stats('reminder_schedule', reminder_schedule.stats)
+for backend in (sheets_io, firestore_io, storage_io, gemini_io):
+    register_stats(f"io_{backend.name}", backend.stats)
+register_stats('measurement_writer', lambda: {'pending': measurement_writer.pending_count()})
+
+# Проверки для /readyz (keep_alive.build_web_app)
+readiness_checks = {'sheets': sheets_ready, 'firestore': firestore_ready}
+
+async def post_init(application):
+    """Хук Application.post_init: загружает состояние и восстанавливает напоминания после перезапуска."""
+    await firestore_io.run(profile_state.items)
+    reminder_schedule.load(await firestore_io.run(reminder_state.items))
+    reminder_schedule.start(application.job_queue)
+    print(f"Напоминания восстановлены: {reminder_schedule.stats()}")
+
+async def post_shutdown(application):
+    """Хук Application.post_shutdown: останавливает фоновые пулы и дописывает локальные копии."""
+    reminder_schedule.stop()
+    for state in (profile_state, reminder_state):
+        state.stop()
+    charts_sent_store.stop()
+    chart_cache.stop()
+    chart_renderer.shutdown()
+    for backend in (sheets_io, firestore_io, storage_io, gemini_io):
+        backend.shutdown()
+
 # --- Единый обработчик диалогов ---
 main_conv = ConversationHandler(
     entry_points=[
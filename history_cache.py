@@ -0,0 +1,113 @@
+# history_cache.py
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Накладные расходы на одну запись окна (кортеж, роль, метка времени), байт
+_ROW_OVERHEAD = 200
+
+
+class _Window:
+    __slots__ = ("rows", "size", "expires_at")
+
+    def __init__(self, rows, maxlen, expires_at):
+        self.rows = deque(rows, maxlen=maxlen)
+        self.size = sum(_row_size(row) for row in self.rows)
+        self.expires_at = expires_at
+
+
+def _row_size(row) -> int:
+    return _ROW_OVERHEAD + sys.getsizeof(row[1])
+
+
+class HistoryCache:
+    """
+    Кэш последних сообщений каждого пользователя в памяти процесса.
+    Окно пользователя — кольцевой буфер фиксированной длины; вытеснение
+    по LRU при превышении бюджета памяти и по истечении TTL.
+    """
+
+    def __init__(self, window=20, max_bytes=32 * 1024 * 1024, ttl=1800.0):
+        self.window = window
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id, limit=None):
+        """Возвращает последние limit строк (role, content, timestamp) или None при промахе."""
+        limit = limit or self.window
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or limit > self.window:
+                self.misses += 1
+                return None
+            if entry.expires_at < time.monotonic():
+                self._drop(user_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            rows = list(entry.rows)
+        return rows[-limit:]
+
+    def put(self, user_id, rows):
+        """Загружает окно пользователя целиком (после чтения из БД)."""
+        with self._lock:
+            if user_id in self._entries:
+                self._drop(user_id)
+            entry = _Window(rows, self.window, time.monotonic() + self.ttl)
+            self._entries[user_id] = entry
+            self._bytes += entry.size
+            self._evict()
+
+    def append(self, user_id, row):
+        """
+        Дописывает строку в окно пользователя (write-through).
+        Если окна в кэше нет, ничего не делает: неполное окно хуже промаха.
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            if len(entry.rows) == entry.rows.maxlen:
+                dropped = entry.rows[0]
+                entry.size -= _row_size(dropped)
+                self._bytes -= _row_size(dropped)
+            entry.rows.append(row)
+            entry.size += _row_size(row)
+            self._bytes += _row_size(row)
+            entry.expires_at = time.monotonic() + self.ttl
+            self._entries.move_to_end(user_id)
+            self._evict()
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if user_id in self._entries:
+                self._drop(user_id)
+
+    def _drop(self, user_id):
+        entry = self._entries.pop(user_id)
+        self._bytes -= entry.size
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            user_id = next(iter(self._entries))
+            self._drop(user_id)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'users': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
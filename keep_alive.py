@@ -1,16 +1,140 @@
 # keep_alive.py
-from flask import Flask
-from threading import Thread
+import asyncio
+import hmac
+import json
+import os
+from contextlib import contextmanager
 
-app = Flask('')
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
 
-@app.route('/')
-def home():
-    return "I'm alive"
+import metrics
 
-def run():
-    app.run(host='0.0.0.0', port=8080)
+PORT = int(os.environ.get('PORT', '8080'))
+# Публичный адрес сервиса (например, https://bronhitik-bot.onrender.com); без него бот работает через polling
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+# Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token каждого обновления
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN')
+READY_CHECK_TIMEOUT = float(os.environ.get('READY_CHECK_TIMEOUT', '5'))
 
-def keep_alive():
-    t = Thread(target=run)
-    t.start()
+_SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class _EmbeddedServer(uvicorn.Server):
+    """uvicorn в цикле событий бота: сигналы остановки обрабатывает Application, а не сервер."""
+
+    def install_signal_handlers(self):
+        pass
+
+    @contextmanager
+    def capture_signals(self):
+        yield
+
+
+def build_web_app(application=None, checks: dict = None) -> Starlette:
+    """
+    ASGI-приложение: /healthz (процесс жив), /readyz (готовы ли зависимости),
+    /metrics (метрики в формате Prometheus) и, если передан application PTB, прием обновлений Telegram по WEBHOOK_PATH.
+    checks — {имя: корутина без аргументов, возвращающая True, если сервис готов}.
+    """
+    checks = checks or {}
+
+    async def healthz(request: Request):
+        return PlainTextResponse("ok")
+
+    async def readyz(request: Request):
+        async def run(name, check):
+            try:
+                return name, bool(await asyncio.wait_for(check(), READY_CHECK_TIMEOUT))
+            except Exception as e:
+                print(f"Проверка готовности {name} не пройдена: {e}")
+                return name, False
+
+        results = dict(await asyncio.gather(*(run(name, check) for name, check in checks.items())))
+        return JSONResponse(results, status_code=200 if all(results.values()) else 503)
+
+    async def prometheus_metrics(request: Request):
+        return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+    async def telegram_webhook(request: Request):
+        if WEBHOOK_SECRET_TOKEN and not hmac.compare_digest(request.headers.get(_SECRET_HEADER, ''), WEBHOOK_SECRET_TOKEN):
+            return Response(status_code=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except (json.JSONDecodeError, ValueError, TypeError) as e:
+            print(f"Некорректное обновление от Telegram: {e}")
+            return Response(status_code=400)
+        # Обработка идет в Application; Telegram сразу получает ответ и не повторяет запрос
+        await application.update_queue.put(update)
+        return Response(status_code=200)
+
+    routes = [
+        Route('/', healthz),
+        Route('/healthz', healthz),
+        Route('/readyz', readyz),
+        Route('/metrics', prometheus_metrics),
+    ]
+    if application is not None:
+        routes.append(Route(WEBHOOK_PATH, telegram_webhook, methods=['POST']))
+    return Starlette(routes=routes)
+
+
+async def run_webhook(application, checks: dict = None, allowed_updates=None):
+    """
+    Запускает бота в режиме webhook: один uvicorn на PORT принимает обновления
+    Telegram и отвечает на проверки Render. Хуки post_init/post_shutdown
+    вызываются так же, как при run_polling.
+    """
+    if not WEBHOOK_SECRET_TOKEN:
+        raise ValueError("Для режима webhook нужна переменная окружения WEBHOOK_SECRET_TOKEN.")
+    server = uvicorn.Server(uvicorn.Config(
+        build_web_app(application, checks), host='0.0.0.0', port=PORT, log_level='warning',
+    ))
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            allowed_updates=allowed_updates,
+            drop_pending_updates=False,
+        )
+        await application.start()
+        try:
+            await server.serve()
+        finally:
+            await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+
+def keep_alive(application, checks: dict = None):
+    """
+    Для режима polling: встраивает сервер проверок здоровья и метрик в хуки
+    application. Сервер работает задачей в том же цикле событий, что и бот,
+    поэтому проверки готовности могут ждать общие асинхронные пулы.
+    Вызывается до run_polling.
+    """
+    server = _EmbeddedServer(uvicorn.Config(build_web_app(checks=checks), host='0.0.0.0', port=PORT, log_level='warning'))
+    post_init, post_shutdown = application.post_init, application.post_shutdown
+    tasks = []
+
+    async def start_server(app):
+        if post_init:
+            await post_init(app)
+        tasks.append(asyncio.create_task(server.serve()))
+
+    async def stop_server(app):
+        server.should_exit = True
+        if tasks:
+            await tasks.pop()
+        if post_shutdown:
+            await post_shutdown(app)
+
+    application.post_init = start_server
+    application.post_shutdown = stop_server
@@ -1,8 +1,20 @@
 import os
-import telebot
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 import google.generativeai as genai
-import psycopg2
-from psycopg2 import sql
+from telegram import Update
+from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
+
+import keep_alive
+import migrations
+from metrics import instrument_handler, register_stats, timed
+from db import ConnectionPool, WriteBehindBuffer
+from context_builder import ContextBuilder, SummaryStore
+from history_cache import HistoryCache
+from streaming import STREAM_ENABLED, gemini_text_chunks, require_text, stream_reply
 
 # --- НАСТРОЙКА ---
 # Получаем секретные ключи из переменных окружения на Render
@@ -14,55 +26,55 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not all([TELEGRAM_BOT_TOKEN, GEMINI_API_KEY, DATABASE_URL]):
     raise ValueError("Один или несколько секретных ключей не установлены в переменных окружения.")
 
-# Инициализация Gemini AI и Telegram Bot
+# Инициализация Gemini AI
 genai.configure(api_key=GEMINI_API_KEY)
-bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
 model = genai.GenerativeModel('gemini-pro')
 
-# --- РАБОТА С БАЗОЙ ДАННЫХ (без изменений) ---
+# --- РАБОТА С БАЗОЙ ДАННЫХ ---
 
-def get_db_connection():
-    """Устанавливает соединение с базой данных PostgreSQL."""
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        return conn
-    except psycopg2.OperationalError as e:
-        print(f"Ошибка подключения к базе данных: {e}")
-        return None
+# Один пул соединений на процесс вместо нового подключения на каждый вызов
+db_pool = ConnectionPool(
+    DATABASE_URL,
+    minconn=int(os.getenv("DB_POOL_MIN", "1")),
+    maxconn=int(os.getenv("DB_POOL_MAX", "10")),
+    checkout_timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+)
 
-def init_db():
-    """Создает необходимые таблицы в базе данных, если они еще не существуют."""
-    conn = get_db_connection()
-    if not conn:
-        return
+# Ответы модели пишутся отложенно: пачкой через execute_values, вне критического пути
+reply_buffer = WriteBehindBuffer(
+    db_pool,
+    "INSERT INTO chat_history (user_id, role, content, timestamp) VALUES %s",
+    flush_interval=float(os.getenv("HISTORY_FLUSH_INTERVAL", "1.0")),
+)
+
+# Сколько последних сообщений читается из БД; в контекст модели из них попадает
+# не больше CONTEXT_MAX_MESSAGES в пределах бюджета токенов, остальные сворачиваются.
+CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", "20"))
+HISTORY_WINDOW = 2 * CONTEXT_MAX_MESSAGES
+
+# Окна последних сообщений активных пользователей; промах — чтение из БД
+history_cache = HistoryCache(
+    window=HISTORY_WINDOW,
+    max_bytes=int(os.getenv("HISTORY_CACHE_MB", "32")) * 1024 * 1024,
+    ttl=float(os.getenv("HISTORY_CACHE_TTL", "1800")),
+)
 
+# Сборка контекста в пределах бюджета токенов с кратким содержанием старых сообщений
+context_builder = ContextBuilder(
+    SummaryStore(db_pool),
+    model,
+    token_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000")),
+    max_messages=CONTEXT_MAX_MESSAGES,
+)
+
+def init_db():
+    """Прогревает пул соединений и применяет недостающие миграции схемы."""
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    first_name VARCHAR(255),
-                    username VARCHAR(255),
-                    registration_date TIMESTAMP WITH TIME ZONE DEFAULT (NOW() AT TIME ZONE 'utc')
-                );
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS chat_history (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    role VARCHAR(50),
-                    content TEXT,
-                    timestamp TIMESTAMP WITH TIME ZONE DEFAULT (NOW() AT TIME ZONE 'utc'),
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                );
-            """)
-        conn.commit()
+        db_pool.warm()
+        migrations.migrate(db_pool)
         print("База данных успешно инициализирована.")
     except Exception as e:
         print(f"Ошибка при инициализации таблиц: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 
 def add_user_to_db(message):
@@ -71,113 +83,243 @@ def add_user_to_db(message):
     first_name = message.from_user.first_name
     username = message.from_user.username
 
-    conn = get_db_connection()
-    if not conn: return
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO users (user_id, first_name, username)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (user_id) DO UPDATE
-                SET first_name = EXCLUDED.first_name, username = EXCLUDED.username;
-            """, (user_id, first_name, username))
-        conn.commit()
+        with db_pool.connection("add_user_to_db") as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO users (user_id, first_name, username)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET first_name = EXCLUDED.first_name, username = EXCLUDED.username;
+                """, (user_id, first_name, username))
     except Exception as e:
         print(f"Ошибка при добавлении пользователя {user_id}: {e}")
-    finally:
-        if conn: conn.close()
 
 
-def add_message_to_history(user_id, role, content):
-    """Сохраняет сообщение в историю чата в базе данных."""
-    # Для Gemini роль ассистента - 'model'
-    role_to_save = 'model' if role == 'assistant' else role
-    conn = get_db_connection()
-    if not conn: return
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO chat_history (user_id, role, content)
-                VALUES (%s, %s, %s);
-            """, (user_id, role_to_save, content))
-        conn.commit()
-    except Exception as e:
-        print(f"Ошибка при сохранении сообщения для пользователя {user_id}: {e}")
-    finally:
-        if conn: conn.close()
-
-def get_user_history(user_id, limit=20):
-    """Получает последние сообщения пользователя из базы данных для Gemini."""
-    conn = get_db_connection()
-    if not conn: return []
-    history = []
+# --- СОХРАНЕНИЕ ХОДА ДИАЛОГА ---
+
+def _pending_replies(user_id):
+    # Снимок буфера берем до запроса: строка, сброшенная во время запроса, попадет
+    # в обе выборки и отсеется при слиянии, а не потеряется.
+    return [(role, content, ts) for uid, role, content, ts in reply_buffer.pending() if uid == user_id]
+
+def _merge_pending(rows, pending):
+    # Ответы, еще не сброшенные из буфера, в выборку не попали — добавляем их сами
+    return sorted(set(rows) | set(pending), key=lambda r: r[2])
+
+def persist_user_turn(message, limit=HISTORY_WINDOW):
+    """
+    За один запрос к БД обновляет пользователя, сохраняет его сообщение
+    и возвращает предыдущие строки диалога (role, content, timestamp).
+    Если окно пользователя есть в кэше, выборка истории не выполняется вовсе.
+    """
+    user_id = message.from_user.id
+    user_row = ('user', message.text, datetime.now(timezone.utc))
+    params = (user_id, message.from_user.first_name, message.from_user.username,
+              user_row[1], user_row[2])
+    upsert_and_insert = """
+        WITH upserted AS (
+            INSERT INTO users (user_id, first_name, username)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE
+            SET first_name = EXCLUDED.first_name, username = EXCLUDED.username
+            RETURNING user_id
+        ), inserted AS (
+            INSERT INTO chat_history (user_id, role, content, timestamp)
+            SELECT user_id, 'user', %s, %s FROM upserted
+            RETURNING id
+        )
+    """
+
+    cached = history_cache.get(user_id, limit)
+    pending = _pending_replies(user_id) if cached is None else []
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT role, content FROM (
-                    SELECT role, content, timestamp
-                    FROM chat_history
-                    WHERE user_id = %s
-                    ORDER BY timestamp DESC
-                    LIMIT %s
-                ) AS recent_history
-                ORDER BY timestamp ASC;
-            """, (user_id, limit))
-            # Форматируем историю для Gemini
-            for role, content in cur.fetchall():
-                history.append({"role": role, "parts": [content]})
+        with db_pool.connection("persist_user_turn") as conn:
+            with conn.cursor() as cur:
+                if cached is not None:
+                    cur.execute(upsert_and_insert + "SELECT 1;", params)
+                    rows = cached
+                else:
+                    # Все CTE видят один снимок данных, поэтому выборка возвращает
+                    # историю без только что вставленного сообщения — его отправим в send_message.
+                    cur.execute(upsert_and_insert + """
+                        SELECT role, content, timestamp FROM (
+                            SELECT role, content, timestamp
+                            FROM chat_history
+                            WHERE user_id = %s
+                            ORDER BY timestamp DESC
+                            LIMIT %s
+                        ) AS recent_history
+                        ORDER BY timestamp ASC;
+                    """, params + (user_id, limit))
+                    rows = _merge_pending(cur.fetchall(), pending)[-limit:]
     except Exception as e:
-        print(f"Ошибка при получении истории для пользователя {user_id}: {e}")
-    finally:
-        if conn: conn.close()
-    return history
+        print(f"Ошибка при сохранении хода диалога для пользователя {user_id}: {e}")
+        return []
+
+    if cached is None and limit == history_cache.window:
+        history_cache.put(user_id, rows)
+    history_cache.append(user_id, user_row)
+    return rows
+
+def queue_model_reply(user_id, content):
+    """Ставит ответ модели в буфер отложенной записи и дописывает его в кэш."""
+    row = (user_id, 'model', content, datetime.now(timezone.utc))
+    reply_buffer.add(row)
+    history_cache.append(user_id, row[1:])
+
+
+# --- ОГРАНИЧЕНИЕ ПАРАЛЛЕЛЬНОСТИ ---
+
+# Блокирующие вызовы psycopg2 выполняются в отдельном пуле потоков размером с пул соединений,
+# чтобы цикл событий не ждал базу и не создавал лишних потоков сверх доступных соединений.
+db_executor = ThreadPoolExecutor(max_workers=db_pool.maxconn, thread_name_prefix="db")
+
+async def run_db(func, *args):
+    """Выполняет синхронную функцию работы с БД, не блокируя цикл событий."""
+    loop = asyncio.get_running_loop()
+    with timed('postgres', getattr(func, '__name__', 'call')):
+        return await loop.run_in_executor(db_executor, functools.partial(func, *args))
+
+
+class UserConcurrencyLimiter:
+    """Ограничивает число одновременно обрабатываемых сообщений одного пользователя."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphores = {}
+        self._users = {}
+
+    @asynccontextmanager
+    async def slot(self, user_id):
+        semaphore = self._semaphores.get(user_id)
+        if semaphore is None:
+            semaphore = self._semaphores[user_id] = asyncio.Semaphore(self.limit)
+        self._users[user_id] = self._users.get(user_id, 0) + 1
+        try:
+            async with semaphore:
+                yield
+        finally:
+            self._users[user_id] -= 1
+            # Семафоры неактивных пользователей удаляем, чтобы словарь не рос бесконечно
+            if not self._users[user_id]:
+                del self._users[user_id]
+                del self._semaphores[user_id]
+
+user_limiter = UserConcurrencyLimiter(int(os.getenv("USER_CONCURRENCY_LIMIT", "1")))
+
+# Пул соединений, кэш истории и буфер записи видны в /metrics
+register_stats('db_pool', db_pool.stats)
+register_stats('history_cache', history_cache.stats)
+register_stats('reply_buffer', lambda: {'pending': len(reply_buffer.pending())})
+
+# Ссылки на фоновые задачи, чтобы сборщик мусора не отменил их до завершения
+_background_tasks = set()
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 
 # --- ОБРАБОТЧИКИ TELEGRAM ---
 
-@bot.message_handler(commands=['start'])
-def send_welcome(message):
+@instrument_handler
+async def send_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start."""
-    add_user_to_db(message)
+    await run_db(add_user_to_db, update.message)
     welcome_text = (
         "Привет! Я Bronhitik, ваш личный помощник на базе Gemini.\n\n"
         "Задайте мне любой вопрос, и я постараюсь на него ответить."
     )
-    bot.reply_to(message, welcome_text)
+    await update.message.reply_text(welcome_text, do_quote=True)
 
 
-@bot.message_handler(func=lambda message: True)
-def handle_message(message):
+@instrument_handler
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик всех текстовых сообщений."""
+    message = update.message
     user_id = message.from_user.id
     user_text = message.text
 
-    add_user_to_db(message)
-    add_message_to_history(user_id, "user", user_text)
-    
-    conversation_history = get_user_history(user_id)
-    
-    try:
-        # Начинаем чат с моделью Gemini с полной историей
-        chat = model.start_chat(history=conversation_history)
-        # Отправляем последнее сообщение пользователя
-        response = chat.send_message(user_text)
-        
-        ai_response = response.text
+    async with user_limiter.slot(user_id):
+        previous_rows = await run_db(persist_user_turn, message)
 
-        # Сохраняем ответ ассистента в БД
-        add_message_to_history(user_id, "model", ai_response)
+        try:
+            conversation_history, overflow = await run_db(
+                context_builder.build, user_id, previous_rows, user_text
+            )
+            if overflow:
+                # Краткое содержание обновляется в фоне и пригодится со следующего сообщения
+                _spawn(context_builder.summarize(user_id, overflow, run_db))
 
-        bot.reply_to(message, ai_response)
+            # Начинаем чат с моделью Gemini с историей в пределах бюджета
+            chat = model.start_chat(history=conversation_history)
+            # Отправляем последнее сообщение пользователя, не блокируя остальных
+            if STREAM_ENABLED:
+                # Ответ показывается по мере генерации правками одного сообщения
+                # Время — до последнего фрагмента, а не только до открытия потока
+                with timed('gemini', 'send_message_stream'):
+                    response = await chat.send_message_async(user_text, stream=True)
+                    ai_response = await stream_reply(message, gemini_text_chunks(response), do_quote=True)
+            else:
+                with timed('gemini', 'send_message'):
+                    response = await chat.send_message_async(user_text)
+                ai_response = require_text(response.text)
+                await message.reply_text(ai_response, do_quote=True)
 
-    except Exception as e:
-        print(f"Ошибка при обращении к Gemini API: {e}")
-        bot.reply_to(message, "К сожалению, произошла ошибка. Попробуйте еще раз позже.")
+            # Ответ ассистента сохраняется один раз целиком и пишется в БД пачкой в фоне
+            queue_model_reply(user_id, ai_response)
+
+        except Exception as e:
+            print(f"Ошибка при обращении к Gemini API: {e}")
+            await message.reply_text("К сожалению, произошла ошибка. Попробуйте еще раз позже.", do_quote=True)
 
 
 # --- ЗАПУСК БОТА ---
-if __name__ == '__main__':
+
+async def post_init(application: Application):
     print("Инициализация базы данных...")
-    init_db()
+    await run_db(init_db)
+    reply_buffer.start()
+    # Фоновое обслуживание истории: партиции наперед и очистка старше HISTORY_RETENTION_DAYS (0 — хранить все)
+    migrations.HistoryMaintenanceJob(db_pool, int(os.getenv("HISTORY_RETENTION_DAYS", "180"))).start()
+
+async def post_shutdown(application: Application):
+    await run_db(reply_buffer.close)
+    db_executor.shutdown(wait=True)
+    db_pool.close()
+
+def ping_db() -> bool:
+    with db_pool.connection("readyz") as conn, conn.cursor() as cur:
+        cur.execute("SELECT 1")
+        return cur.fetchone() is not None
+
+async def db_ready() -> bool:
+    return await run_db(ping_db)
+
+def build_application() -> Application:
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        # Сколько обновлений обрабатывается одновременно по всем пользователям
+        .concurrent_updates(int(os.getenv("MAX_CONCURRENT_UPDATES", "64")))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    application.add_handler(CommandHandler("start", send_welcome))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
+
+if __name__ == '__main__':
     print("Запуск Gemini бота...")
-    bot.polling(none_stop=True)
+    application = build_application()
+    readiness_checks = {'db': db_ready}
+    if keep_alive.WEBHOOK_URL:
+        # Webhook: обновления приходят на тот же порт, что и проверки Render
+        asyncio.run(keep_alive.run_webhook(application, readiness_checks, allowed_updates=Update.ALL_TYPES))
+    else:
+        keep_alive.keep_alive(application, readiness_checks)
+        application.run_polling()
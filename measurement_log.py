@@ -0,0 +1,159 @@
+# measurement_log.py
+import json
+import os
+import re
+import threading
+
+from measurement_store import CHAT_ID_HEADER, SHEET_COLUMNS
+from metrics import timed
+
+MEASUREMENT_WAL_FILE = os.environ.get('MEASUREMENT_WAL_FILE', 'measurements_wal.jsonl')
+
+# "'Лист1'!A15:K16" -> 16: номер последней строки, записанной append
+_UPDATED_RANGE_RE = re.compile(r"!\$?[A-Z]+\$?\d+(?::\$?[A-Z]+\$?(\d+))?$")
+_SINGLE_CELL_RE = re.compile(r"!\$?[A-Z]+\$?(\d+)$")
+
+
+def _last_row_from_response(response) -> int | None:
+    try:
+        updated_range = response['updates']['updatedRange']
+    except (KeyError, TypeError):
+        return None
+    match = _UPDATED_RANGE_RE.search(updated_range)
+    if match and match.group(1):
+        return int(match.group(1))
+    match = _SINGLE_CELL_RE.search(updated_range)
+    return int(match.group(1)) if match else None
+
+
+class MeasurementWriter:
+    """
+    Запись замеров в таблицу только добавлением строк.
+
+    Номер записи берется из счетчика: он один раз читается по первому столбцу
+    и дальше уточняется по ответу append, так что весь лист больше не скачивается.
+    Строки сначала попадают в локальный журнал (write-ahead), а в таблицу
+    уходят пачкой через append_rows; если Sheets недоступна, журнал
+    переотправляется при следующей записи или по таймеру.
+    """
+
+    def __init__(self, get_sheet, wal_path=MEASUREMENT_WAL_FILE, max_batch=100, on_append=None):
+        self.get_sheet = get_sheet
+        # on_append(last_row, numbered_rows) вызывается после успешной записи пачки
+        self.on_append = on_append
+        self.wal_path = wal_path
+        self.max_batch = max_batch
+        # _lock охраняет очередь и журнал и никогда не держится во время запросов к таблице;
+        # _flush_lock выстраивает отправки пачек по одной
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._next_number = None
+        self._generation = 0
+        self._pending = self._load_wal()
+
+    # --- Журнал ---
+
+    def _load_wal(self) -> list:
+        try:
+            with open(self.wal_path, 'r', encoding='utf-8') as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Ошибка чтения журнала замеров {self.wal_path}: {e}")
+            return []
+
+    def _append_wal(self, row):
+        with open(self.wal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite_wal(self):
+        tmp_path = self.wal_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for row in self._pending:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.wal_path)
+
+    # --- Запись ---
+
+    def _ensure_header(self, sheet):
+        # Столбец chat_id добавлен позже остальных: подписываем его в заголовке, если нужно
+        header = sheet.row_values(1)
+        if CHAT_ID_HEADER not in header:
+            sheet.update_cell(1, len(SHEET_COLUMNS), CHAT_ID_HEADER)
+
+    def pending_count(self) -> int:
+        # len() списка атомарен: для /metrics блокировка не нужна
+        return len(self._pending)
+
+    def append(self, row: list) -> bool:
+        """
+        Ставит строку (без номера записи, с chat_id последним столбцом) в очередь и пытается отправить очередь.
+        Возвращает True, если все строки уже в таблице.
+        """
+        with self._lock:
+            self._pending.append(row)
+            try:
+                self._append_wal(row)
+            except OSError as e:
+                print(f"Ошибка записи в журнал замеров: {e}")
+        return self.flush()
+
+    def flush(self) -> bool:
+        """Отправляет накопленные строки в таблицу. Возвращает True, если очередь пуста."""
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = self._pending[:self.max_batch]
+                    next_number = self._next_number
+                    generation = self._generation
+                if not batch:
+                    return True
+                sheet = self.get_sheet()
+                if not sheet:
+                    return False
+                try:
+                    if next_number is None:
+                        # Один раз на процесс: первый столбец с заголовком -> номер следующей записи
+                        next_number = len(sheet.col_values(1))
+                        self._ensure_header(sheet)
+                    numbered = [[next_number + i] + row for i, row in enumerate(batch)]
+                    with timed('sheets', 'append_rows'):
+                        response = sheet.append_rows(numbered, value_input_option='USER_ENTERED')
+                except Exception as e:
+                    print(f"Ошибка записи в Google Sheets, строк в очереди: {len(self._pending)}: {e}")
+                    # Счетчик перечитаем: часть строк могла записаться до ошибки
+                    with self._lock:
+                        self._next_number = None
+                    return False
+
+                last_row = _last_row_from_response(response)
+                with self._lock:
+                    # Пока шел запрос, очередь могли сбросить — снимать с нее уже нечего
+                    if generation != self._generation:
+                        return not self._pending
+                    # Строка 1 — заголовок, поэтому номер следующей записи равен номеру последней строки
+                    self._next_number = last_row if last_row else next_number + len(batch)
+                    self._pending = self._pending[len(batch):]
+                    try:
+                        self._rewrite_wal()
+                    except OSError as e:
+                        print(f"Ошибка обновления журнала замеров: {e}")
+                if self.on_append and last_row:
+                    try:
+                        self.on_append(last_row, numbered)
+                    except Exception as e:
+                        print(f"Ошибка обработки записанных замеров: {e}")
+
+    def reset(self):
+        """Забывает счетчик и очередь (после очистки таблицы)."""
+        with self._lock:
+            self._next_number = None
+            self._pending = []
+            self._generation += 1
+            try:
+                self._rewrite_wal()
+            except OSError as e:
+                print(f"Ошибка обновления журнала замеров: {e}")
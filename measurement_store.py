@@ -0,0 +1,269 @@
+# measurement_store.py
+import os
+import sqlite3
+import threading
+import time
+from datetime import date
+
+import numpy as np
+
+from aggregation import parse_dates
+from metrics import timed
+
+MEASUREMENT_DB_FILE = os.environ.get('MEASUREMENT_DB_FILE', 'measurements.sqlite3')
+# Строки, записанные до появления столбца chat_id, можно закрепить за одним чатом
+LEGACY_CHAT_ID = os.environ.get('LEGACY_MEASUREMENTS_CHAT_ID')
+
+# Порядок столбцов листа (так их пишет MeasurementWriter)
+SHEET_COLUMNS = [
+    'number', 'date', 'time', 'time_of_day', 'peakflow',
+    'breathing', 'cough', 'sputum', 'meds', 'age', 'sex', 'chat_id',
+]
+CHAT_ID_HEADER = 'chat_id'
+# Заголовки листа, по которым столбцы ищутся в первую очередь
+SHEET_HEADERS = {'Дата': 'date', 'Время суток': 'time_of_day', 'Пикфлоуметр': 'peakflow', CHAT_ID_HEADER: 'chat_id'}
+_LAST_COLUMN = chr(ord('A') + len(SHEET_COLUMNS) - 1)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS measurements (
+    row_number INTEGER PRIMARY KEY,
+    record_number INTEGER,
+    chat_id TEXT,
+    date TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    time TEXT,
+    time_of_day TEXT,
+    peakflow INTEGER,
+    breathing TEXT,
+    cough TEXT,
+    sputum TEXT,
+    meds TEXT,
+    age TEXT,
+    sex TEXT
+);
+CREATE INDEX IF NOT EXISTS measurements_chat_date ON measurements (chat_id, date);
+CREATE INDEX IF NOT EXISTS measurements_date ON measurements (date);
+CREATE TABLE IF NOT EXISTS month_versions (
+    chat_id TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, year, month)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def _to_int(value):
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+class MeasurementStore:
+    """
+    Локальная копия листа замеров в SQLite с типизированными столбцами.
+    Синхронизируется с Google Sheets инкрементально — читаются только строки
+    после последней синхронизированной, — а новые замеры попадают сюда сразу при записи.
+    """
+
+    def __init__(self, path=MEASUREMENT_DB_FILE, sync_interval=300.0):
+        self.path = path
+        self.sync_interval = sync_interval
+        # _lock охраняет только SQLite и состояние; сетевые запросы к листу идут без него,
+        # а _sync_lock не даёт двум синхронизациям читать один и тот же диапазон
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        if LEGACY_CHAT_ID:
+            updated = self._conn.execute(
+                "UPDATE measurements SET chat_id = ? WHERE chat_id IS NULL", (LEGACY_CHAT_ID,)
+            ).rowcount
+            if updated:
+                self._conn.execute(
+                    "INSERT INTO month_versions (chat_id, year, month, version) "
+                    "SELECT DISTINCT chat_id, year, month, 1 FROM measurements WHERE chat_id = ? "
+                    "ON CONFLICT (chat_id, year, month) DO UPDATE SET version = version + 1",
+                    (LEGACY_CHAT_ID,),
+                )
+            self._conn.commit()
+        self._column_map = None
+        self._last_sync = 0.0
+        self._generation = 0
+
+    # --- Состояние синхронизации ---
+
+    def _get_state(self, key, default=0):
+        row = self._conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_state(self, key, value):
+        self._conn.execute(
+            "INSERT INTO sync_state (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+    @property
+    def last_synced_row(self) -> int:
+        with self._lock:
+            return self._get_state('last_row', 1)
+
+    # --- Разбор строк листа ---
+
+    @staticmethod
+    def _columns(header):
+        mapping = {name: i for i, name in enumerate(SHEET_COLUMNS)}
+        for i, title in enumerate(header):
+            if title in SHEET_HEADERS:
+                mapping[SHEET_HEADERS[title]] = i
+        return mapping
+
+    @staticmethod
+    def _parse_rows(first_row, rows, columns):
+        """Разбирает пачку строк листа; даты — одним векторизованным проходом."""
+        def cell(values, name):
+            i = columns.get(name)
+            return values[i] if i is not None and i < len(values) else None
+
+        years, months, days, valid = parse_dates(cell(values, 'date') for values in rows)
+        parsed = []
+        for i in np.flatnonzero(valid):
+            values = rows[i]
+            year, month, day = int(years[i]), int(months[i]), int(days[i])
+            time_of_day = cell(values, 'time_of_day')
+            chat_id = str(cell(values, 'chat_id')).strip() if cell(values, 'chat_id') else LEGACY_CHAT_ID
+            parsed.append((
+                first_row + int(i), _to_int(cell(values, 'number')), chat_id,
+                f"{year:04d}-{month:02d}-{day:02d}", year, month, day,
+                cell(values, 'time'), str(time_of_day).strip().lower() if time_of_day else None,
+                _to_int(cell(values, 'peakflow')),
+                cell(values, 'breathing'), cell(values, 'cough'), cell(values, 'sputum'), cell(values, 'meds'),
+                cell(values, 'age'), cell(values, 'sex'),
+            ))
+        return parsed
+
+    def _insert(self, parsed_rows):
+        rows = [row for row in parsed_rows if row]
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO measurements VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        # Версия данных месяца меняется при каждой записи — по ней инвалидируются кэши графиков
+        self._conn.executemany(
+            "INSERT INTO month_versions (chat_id, year, month, version) VALUES (?, ?, ?, 1) "
+            "ON CONFLICT (chat_id, year, month) DO UPDATE SET version = version + 1",
+            {(row[2], row[4], row[5]) for row in rows if row[2] is not None},
+        )
+
+    # --- Синхронизация ---
+
+    def sync(self, sheet) -> int:
+        """Догружает строки листа после последней синхронизированной. Возвращает число новых строк."""
+        with self._sync_lock:
+            with self._lock:
+                columns = self._column_map
+                start = self._get_state('last_row', 1) + 1
+                generation = self._generation
+            # Запросы к листу — вне _lock, чтобы чтение из обработчиков не ждало сеть
+            if columns is None:
+                columns = self._columns(sheet.row_values(1))
+            # Открытый диапазон: один запрос, только новые строки
+            with timed('sheets', 'get_range'):
+                values = sheet.get(f"A{start}:{_LAST_COLUMN}")
+            parsed = self._parse_rows(start, values, columns) if values else []
+            with self._lock:
+                # Пока шёл запрос, копию могли очистить — тогда прочитанное уже неактуально
+                if generation != self._generation:
+                    return 0
+                self._column_map = columns
+                if values:
+                    self._insert(parsed)
+                    # add_rows мог за это время сдвинуть указатель дальше
+                    last_row = max(self._get_state('last_row', 1), start + len(values) - 1)
+                    self._set_state('last_row', last_row)
+                    self._conn.commit()
+                self._last_sync = time.monotonic()
+        return len(values or [])
+
+    def sync_if_stale(self, get_sheet) -> bool:
+        """Синхронизирует, если с прошлой синхронизации прошло больше sync_interval секунд."""
+        if time.monotonic() - self._last_sync < self.sync_interval:
+            return True
+        sheet = get_sheet()
+        if not sheet:
+            return False
+        try:
+            self.sync(sheet)
+            return True
+        except Exception as e:
+            print(f"Ошибка синхронизации замеров с таблицей: {e}")
+            return False
+
+    def add_rows(self, last_row: int, numbered_rows: list):
+        """
+        Записывает только что добавленные в лист строки (write-through).
+        last_row — номер последней строки листа, занятой этой пачкой.
+        """
+        first_row = last_row - len(numbered_rows) + 1
+        columns = {name: i for i, name in enumerate(SHEET_COLUMNS)}
+        with self._lock:
+            self._insert(self._parse_rows(first_row, numbered_rows, columns))
+            # Указатель двигаем, только если между ним и пачкой нет пропуска
+            if self._get_state('last_row', 1) == first_row - 1:
+                self._set_state('last_row', last_row)
+            self._conn.commit()
+
+    def reset(self):
+        """Очищает локальную копию (после удаления данных из листа)."""
+        with self._lock:
+            self._conn.execute("DELETE FROM measurements")
+            self._conn.execute("DELETE FROM sync_state")
+            self._conn.execute("DELETE FROM month_versions")
+            self._conn.commit()
+            self._column_map = None
+            self._last_sync = 0.0
+            self._generation += 1
+
+    # --- Чтение ---
+
+    def months(self, chat_id) -> list:
+        """Месяцы, за которые у чата есть замеры: [(год, месяц), ...] от новых к старым."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT year, month FROM measurements WHERE chat_id = ? "
+                "ORDER BY year DESC, month DESC",
+                (str(chat_id),),
+            ).fetchall()
+        return [(row['year'], row['month']) for row in rows]
+
+    def month_version(self, chat_id, year: int, month: int) -> int:
+        """Версия данных чата за месяц: 0, если замеров нет."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version FROM month_versions WHERE chat_id = ? AND year = ? AND month = ?",
+                (str(chat_id), year, month),
+            ).fetchone()
+        return row[0] if row else 0
+
+    def query(self, chat_id, start: date, end: date) -> list:
+        """Замеры чата с start по end включительно; поиск по индексу (chat_id, date)."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT * FROM measurements WHERE chat_id = ? AND date BETWEEN ? AND ? "
+                "ORDER BY date, row_number",
+                (str(chat_id), start.isoformat(), end.isoformat()),
+            ).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,208 @@
+# metrics.py
+"""
+Встроенные метрики бота в формате Prometheus и структурированные логи.
+
+    with timed('sheets', 'append_rows'):
+        ...
+    @instrument_handler
+    async def handler(update, context): ...
+    register_stats('history_cache', history_cache.stats)
+
+render() отдает текст для эндпоинта /metrics (keep_alive.py).
+При LOG_FORMAT=json log_event() пишет события одной JSON-строкой.
+"""
+import functools
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+_PREFIX = 'bot'
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _name(*parts) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', '_'.join(str(p) for p in parts if p))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for values, total in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, values)} {total}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels=(), buckets=_DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0, 0.0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        names = self.label_names + ('le',)
+        with self._lock:
+            for values, (counts, count, total) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_labels(names, values + (bound,))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_labels(names, values + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, values)} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, values)} {total}")
+        return lines
+
+
+class Registry:
+    """Метрики процесса и функции-источники текущих значений (пулы, кэши, очереди)."""
+
+    def __init__(self):
+        self._metrics = []
+        self._stats = {}
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix: str, stats_fn):
+        self._stats[prefix] = stats_fn
+
+    def _render_stats(self, prefix: str, stats: dict) -> list:
+        lines = []
+        for key, value in stats.items():
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                lines.append(f"{_name(_PREFIX, prefix, key)} {value}")
+            elif isinstance(value, dict):
+                for inner, inner_value in value.items():
+                    if isinstance(inner_value, (int, float)):
+                        lines.append(f"{_name(_PREFIX, prefix, key)}{_labels(('key',), (inner,))} {inner_value}")
+                    elif isinstance(inner_value, dict):
+                        for field, number in inner_value.items():
+                            if isinstance(number, (int, float)):
+                                lines.append(f"{_name(_PREFIX, prefix, key, field)}{_labels(('name',), (inner,))} {number}")
+        hits, misses = stats.get('hits'), stats.get('misses')
+        if isinstance(hits, int) and isinstance(misses, int) and hits + misses:
+            lines.append(f"{_name(_PREFIX, prefix, 'hit_ratio')} {hits / (hits + misses):.4f}")
+        return lines
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, stats_fn in list(self._stats.items()):
+            try:
+                lines.extend(self._render_stats(prefix, stats_fn()))
+            except Exception as e:
+                print(f"Ошибка сбора метрик {prefix}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+external_call_seconds = REGISTRY.add(Histogram(
+    'bot_external_call_seconds', 'Длительность вызовов внешних сервисов', labels=('service', 'operation'),
+))
+external_call_errors = REGISTRY.add(Counter(
+    'bot_external_call_errors_total', 'Ошибки вызовов внешних сервисов', labels=('service', 'operation', 'error'),
+))
+handler_seconds = REGISTRY.add(Histogram(
+    'bot_handler_seconds', 'Время обработки обновления обработчиком', labels=('handler',),
+))
+handler_errors = REGISTRY.add(Counter(
+    'bot_handler_errors_total', 'Необработанные исключения в обработчиках', labels=('handler', 'error'),
+))
+
+
+def register_stats(prefix: str, stats_fn):
+    REGISTRY.register_stats(prefix, stats_fn)
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+def log_event(event: str, **fields):
+    """Событие для логов: JSON-строка при LOG_FORMAT=json, иначе ничего (ошибки уже печатаются)."""
+    if LOG_FORMAT != 'json':
+        return
+    print(json.dumps({'ts': round(time.time(), 3), 'event': event, **fields}, ensure_ascii=False, default=str), flush=True)
+
+
+def _record(service: str, operation: str, started: float, error: BaseException = None):
+    elapsed = time.perf_counter() - started
+    external_call_seconds.observe(elapsed, service, operation)
+    if error is not None:
+        external_call_errors.inc(service, operation, type(error).__name__)
+    log_event('external_call', service=service, operation=operation, seconds=round(elapsed, 4),
+              error=type(error).__name__ if error is not None else None)
+
+
+@contextmanager
+def timed(service: str, operation: str):
+    """Замеряет блок кода как вызов внешнего сервиса."""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        _record(service, operation, started, e)
+        raise
+    _record(service, operation, started)
+
+
+def instrument_handler(fn):
+    """Гистограмма времени и счетчик ошибок для обработчика Telegram."""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            handler_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            handler_seconds.observe(elapsed, name)
+            log_event('handler', handler=name, seconds=round(elapsed, 4))
+    return wrapper
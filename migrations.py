@@ -0,0 +1,315 @@
+# migrations.py
+"""
+Версионированные миграции схемы PostgreSQL и обслуживание chat_history.
+
+Запуск вручную:
+    python migrations.py status     — показать примененные версии
+    python migrations.py migrate    — применить недостающие миграции
+    python migrations.py partition  — перевести chat_history на помесячные партиции
+    python migrations.py partitions — создать партиции на ближайшие месяцы
+    python migrations.py retention  — удалить историю старше HISTORY_RETENTION_DAYS
+"""
+import os
+import sys
+import threading
+from datetime import date, datetime, timedelta, timezone
+
+# Произвольный ключ advisory-блокировки, чтобы два процесса не мигрировали одновременно
+MIGRATION_LOCK_KEY = 72_410_001
+
+# (версия, описание, SQL, выполнять ли в транзакции)
+MIGRATIONS = [
+    (1, "initial schema", """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            first_name VARCHAR(255),
+            username VARCHAR(255),
+            registration_date TIMESTAMP WITH TIME ZONE DEFAULT (NOW() AT TIME ZONE 'utc')
+        );
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            role VARCHAR(50),
+            content TEXT,
+            timestamp TIMESTAMP WITH TIME ZONE DEFAULT (NOW() AT TIME ZONE 'utc'),
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        );
+    """, True),
+    # CONCURRENTLY не блокирует запись в большую таблицу, но не работает внутри транзакции
+    (2, "chat_history (user_id, timestamp DESC) index", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_history_user_ts_idx
+        ON chat_history (user_id, timestamp DESC);
+    """, False),
+    # BRIN почти ничего не стоит при вставке и ускоряет очистку по времени
+    (3, "chat_history timestamp BRIN index", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_history_ts_brin
+        ON chat_history USING brin (timestamp);
+    """, False),
+    (4, "chat_summaries", """
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            user_id BIGINT PRIMARY KEY REFERENCES users (user_id),
+            summary TEXT NOT NULL,
+            covered_until TIMESTAMP WITH TIME ZONE NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+    """, True),
+]
+
+
+# --- Применение миграций ---
+
+def _ensure_migrations_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+    """)
+
+def applied_versions(db_pool) -> set:
+    with db_pool.connection("migrations_status") as conn:
+        with conn.cursor() as cur:
+            _ensure_migrations_table(cur)
+            cur.execute("SELECT version FROM schema_migrations;")
+            return {row[0] for row in cur.fetchall()}
+
+def migrate(db_pool) -> list:
+    """Применяет по порядку все миграции, которых еще нет в schema_migrations."""
+    applied = []
+    with db_pool.connection("migrate") as conn:
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_KEY,))
+                try:
+                    _ensure_migrations_table(cur)
+                    cur.execute("SELECT version FROM schema_migrations;")
+                    done = {row[0] for row in cur.fetchall()}
+                    for version, name, statement, transactional in MIGRATIONS:
+                        if version in done:
+                            continue
+                        if transactional:
+                            cur.execute("BEGIN;")
+                        try:
+                            cur.execute(statement)
+                            cur.execute(
+                                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s);",
+                                (version, name),
+                            )
+                        except Exception:
+                            if transactional:
+                                cur.execute("ROLLBACK;")
+                            raise
+                        if transactional:
+                            cur.execute("COMMIT;")
+                        applied.append(version)
+                        print(f"Применена миграция {version}: {name}")
+                finally:
+                    cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_KEY,))
+        finally:
+            conn.autocommit = False
+    return applied
+
+
+# --- Партиционирование chat_history по времени ---
+
+def _month_start(d: date) -> date:
+    return d.replace(day=1)
+
+def _next_month(d: date) -> date:
+    return (d.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def is_partitioned(cur) -> bool:
+    cur.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_partitioned_table pt
+            JOIN pg_class c ON c.oid = pt.partrelid
+            WHERE c.relname = 'chat_history'
+        );
+    """)
+    return cur.fetchone()[0]
+
+def ensure_partitions(cur, start: date, months_ahead: int = 2):
+    """Создает помесячные партиции от start до текущего месяца плюс months_ahead."""
+    month = _month_start(start)
+    last = _month_start(date.today())
+    for _ in range(months_ahead):
+        last = _next_month(last)
+    while month <= last:
+        upper = _next_month(month)
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS chat_history_{month:%Y_%m}
+            PARTITION OF chat_history
+            FOR VALUES FROM ('{month.isoformat()}') TO ('{upper.isoformat()}');
+        """)
+        month = upper
+
+def partition_chat_history(db_pool):
+    """
+    Однократно переводит chat_history на помесячное партиционирование.
+    Старые данные переносятся в партиции, идентификаторы сохраняются.
+    """
+    with db_pool.connection("partition_chat_history") as conn:
+        with conn.cursor() as cur:
+            if is_partitioned(cur):
+                print("chat_history уже партиционирована.")
+                return False
+            cur.execute("LOCK TABLE chat_history IN ACCESS EXCLUSIVE MODE;")
+            cur.execute("SELECT MIN(timestamp) FROM chat_history;")
+            oldest = cur.fetchone()[0]
+            cur.execute("ALTER TABLE chat_history RENAME TO chat_history_legacy;")
+            cur.execute("ALTER TABLE chat_history_legacy RENAME CONSTRAINT chat_history_pkey TO chat_history_legacy_pkey;")
+            cur.execute("ALTER INDEX IF EXISTS chat_history_user_ts_idx RENAME TO chat_history_legacy_user_ts_idx;")
+            cur.execute("ALTER INDEX IF EXISTS chat_history_ts_brin RENAME TO chat_history_legacy_ts_brin;")
+            # Ключ партиционирования обязан входить в первичный ключ
+            cur.execute("""
+                CREATE TABLE chat_history (
+                    id BIGINT NOT NULL DEFAULT nextval('chat_history_id_seq'),
+                    user_id BIGINT REFERENCES users (user_id),
+                    role VARCHAR(50),
+                    content TEXT,
+                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT (NOW() AT TIME ZONE 'utc'),
+                    PRIMARY KEY (id, timestamp)
+                ) PARTITION BY RANGE (timestamp);
+            """)
+            cur.execute("ALTER SEQUENCE chat_history_id_seq OWNED BY chat_history.id;")
+            cur.execute("CREATE INDEX chat_history_user_ts_idx ON chat_history (user_id, timestamp DESC);")
+            cur.execute("CREATE INDEX chat_history_ts_brin ON chat_history USING brin (timestamp);")
+            cur.execute("CREATE TABLE chat_history_default PARTITION OF chat_history DEFAULT;")
+            ensure_partitions(cur, oldest.date() if oldest else date.today())
+            cur.execute("""
+                INSERT INTO chat_history (id, user_id, role, content, timestamp)
+                SELECT id, user_id, role, content, COALESCE(timestamp, NOW())
+                FROM chat_history_legacy;
+            """)
+            cur.execute("DROP TABLE chat_history_legacy;")
+    print("chat_history переведена на помесячные партиции.")
+    return True
+
+
+def maintain_partitions(db_pool) -> bool:
+    """
+    Заранее создает партиции текущего и следующих месяцев. Без них строки
+    попадают в chat_history_default, и партицию за тот же месяц потом уже
+    не создать. Возвращает False, если таблица не партиционирована.
+    """
+    with db_pool.connection("maintain_partitions") as conn:
+        with conn.cursor() as cur:
+            if not is_partitioned(cur):
+                return False
+            ensure_partitions(cur, date.today())
+    return True
+
+
+# --- Очистка старой истории ---
+
+def run_retention(db_pool, retention_days: int, batch_size: int = 5000) -> int:
+    """
+    Удаляет историю старше retention_days. Целые партиции старше порога
+    удаляются целиком, остаток — пачками, чтобы не держать долгих блокировок.
+    """
+    if retention_days <= 0:
+        return 0
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    removed = 0
+
+    with db_pool.connection("retention_partitions") as conn:
+        with conn.cursor() as cur:
+            if is_partitioned(cur):
+                cur.execute("""
+                    SELECT c.relname FROM pg_inherits i
+                    JOIN pg_class c ON c.oid = i.inhrelid
+                    JOIN pg_class p ON p.oid = i.inhparent
+                    WHERE p.relname = 'chat_history' AND c.relname ~ '^chat_history_[0-9]{4}_[0-9]{2}$';
+                """)
+                for (relname,) in cur.fetchall():
+                    year, month = int(relname[-7:-3]), int(relname[-2:])
+                    upper = _next_month(date(year, month, 1))
+                    if upper <= cutoff.date():
+                        cur.execute(f"ALTER TABLE chat_history DETACH PARTITION {relname};")
+                        cur.execute(f"DROP TABLE {relname};")
+                        print(f"Удалена партиция истории {relname}")
+
+    while True:
+        with db_pool.connection("retention_delete") as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM chat_history
+                    WHERE id IN (
+                        SELECT id FROM chat_history WHERE timestamp < %s LIMIT %s
+                    );
+                """, (cutoff, batch_size))
+                deleted = cur.rowcount
+        removed += deleted
+        if deleted < batch_size:
+            break
+    if removed:
+        print(f"Удалено устаревших сообщений истории: {removed}")
+    return removed
+
+class HistoryMaintenanceJob:
+    """
+    Фоновый поток обслуживания chat_history: при запуске и затем каждые
+    interval_hours создает партиции наперед, а при retention_days > 0
+    еще и удаляет старую историю. Партиции создаются и при выключенной очистке.
+    """
+
+    def __init__(self, db_pool, retention_days: int, interval_hours: float = 6.0):
+        self.db_pool = db_pool
+        self.retention_days = retention_days
+        self.interval = interval_hours * 3600
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="history-maintenance", daemon=True)
+        self._thread.start()
+
+    def run_once(self):
+        try:
+            maintain_partitions(self.db_pool)
+        except Exception as e:
+            print(f"Ошибка создания партиций истории: {e}")
+        if self.retention_days <= 0:
+            return
+        try:
+            run_retention(self.db_pool, self.retention_days)
+        except Exception as e:
+            print(f"Ошибка очистки истории: {e}")
+
+    def _run(self):
+        self.run_once()
+        while not self._stopped.wait(self.interval):
+            self.run_once()
+
+    def stop(self):
+        self._stopped.set()
+
+
+if __name__ == '__main__':
+    from db import ConnectionPool
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    pool = ConnectionPool(os.getenv("DATABASE_URL"))
+    try:
+        if command == "migrate":
+            migrate(pool)
+        elif command == "partition":
+            migrate(pool)
+            partition_chat_history(pool)
+        elif command == "partitions":
+            if not maintain_partitions(pool):
+                print("chat_history не партиционирована.")
+        elif command == "retention":
+            maintain_partitions(pool)
+            run_retention(pool, int(os.getenv("HISTORY_RETENTION_DAYS", "180")))
+        else:
+            done = applied_versions(pool)
+            for version, name, _, _ in MIGRATIONS:
+                mark = "x" if version in done else " "
+                print(f"[{mark}] {version:03d} {name}")
+    finally:
+        pool.close()
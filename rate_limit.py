@@ -0,0 +1,37 @@
+# rate_limit.py
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Асинхронный «ведро токенов»: не больше rate операций в секунду
+    в среднем и не больше capacity подряд.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1.0):
+        # Очередь через lock сохраняет порядок ожидающих
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Забирает все токены на seconds секунд (например, после ответа 429 с retry_after)."""
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
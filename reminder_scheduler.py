@@ -0,0 +1,123 @@
+# reminder_scheduler.py
+import os
+import threading
+import time
+from datetime import timedelta, timezone
+
+REMINDER_TZ = timezone(timedelta(hours=3))
+# Сколько пропущенных минут догонять, если тик задержался или был пропущен
+REMINDER_CATCHUP_MINUTES = int(os.environ.get('REMINDER_CATCHUP_MINUTES', '5'))
+_DAY_MINUTES = 24 * 60
+
+
+def minute_of_day(time_str: str) -> int:
+    """'08:30' -> 510."""
+    hours, minutes = time_str.strip().split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"Некорректное время: {time_str}")
+    return hours * 60 + minutes
+
+
+class ReminderSchedule:
+    """
+    Напоминания, разложенные по минутам суток.
+
+    Вместо двух ежедневных задач на пользователя — одна общая задача, которая
+    раз в минуту берет всех, кому пора напомнить, и отправляет им пачкой.
+    Индекс строится при старте одним проходом по сохраненным напоминаниям,
+    поэтому после перезапуска ничего не теряется, а память и время старта
+    растут только с числом записей, без задач планировщика на каждую.
+    """
+
+    def __init__(self, send, tz=REMINDER_TZ, catchup_minutes=REMINDER_CATCHUP_MINUTES):
+        # send(bot, chat_ids, scheduled_at) — корутина отправки одной пачки
+        self._send = send
+        self._offset = int(tz.utcoffset(None).total_seconds() // 60)
+        self.catchup_minutes = catchup_minutes
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._by_chat = {}
+        self._last_minute = None
+        self._job = None
+        self.sent_batches = 0
+
+    # --- Индекс ---
+
+    def load(self, items):
+        """Массовая загрузка пар (chat_id, Reminder) при старте."""
+        buckets, by_chat = {}, {}
+        for chat_id, reminder in items:
+            minutes = self._minutes(chat_id, reminder)
+            if not minutes:
+                continue
+            by_chat[str(chat_id)] = minutes
+            for minute in minutes:
+                buckets.setdefault(minute, set()).add(str(chat_id))
+        with self._lock:
+            self._buckets, self._by_chat = buckets, by_chat
+
+    @staticmethod
+    def _minutes(chat_id, reminder) -> tuple:
+        if reminder is None:
+            return ()
+        try:
+            return tuple(sorted({minute_of_day(t) for t in reminder.times}))
+        except (ValueError, AttributeError) as e:
+            print(f"Пропускаю некорректные напоминания чата {chat_id}: {e}")
+            return ()
+
+    def update(self, chat_id, reminder):
+        """Обновляет время напоминаний чата; reminder=None — удалить."""
+        chat_id = str(chat_id)
+        minutes = self._minutes(chat_id, reminder)
+        with self._lock:
+            for minute in self._by_chat.pop(chat_id, ()):
+                bucket = self._buckets.get(minute)
+                if bucket is not None:
+                    bucket.discard(chat_id)
+                    if not bucket:
+                        del self._buckets[minute]
+            if minutes:
+                self._by_chat[chat_id] = minutes
+                for minute in minutes:
+                    self._buckets.setdefault(minute, set()).add(chat_id)
+
+    def due(self, minute: int) -> list:
+        with self._lock:
+            return list(self._buckets.get(minute, ()))
+
+    # --- Планировщик ---
+
+    def start(self, job_queue):
+        """Регистрирует единственную повторяющуюся задачу, выровненную по началу минуты."""
+        if self._job is not None:
+            return
+        now = time.time()
+        # Минута запуска еще не обработана: первый тик отправит и ее напоминания
+        self._last_minute = int(now // 60) - 1
+        self._job = job_queue.run_repeating(self._tick, interval=60, first=60 - now % 60 + 0.5, name="reminder_tick")
+
+    def stop(self):
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+
+    async def _tick(self, context):
+        current = int(time.time() // 60)
+        first = max(self._last_minute + 1, current - self.catchup_minutes + 1)
+        self._last_minute = current
+        for absolute_minute in range(first, current + 1):
+            chat_ids = self.due((absolute_minute + self._offset) % _DAY_MINUTES)
+            if chat_ids:
+                self.sent_batches += 1
+                # Отправка идет отдельной задачей, чтобы следующий тик не ждал большую пачку
+                context.application.create_task(self._send(context.bot, chat_ids, absolute_minute * 60))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'chats': len(self._by_chat),
+                'minutes': len(self._buckets),
+                'sent_batches': self.sent_batches,
+            }
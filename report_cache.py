@@ -0,0 +1,98 @@
+# report_cache.py
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+AI_REPORT_CACHE_TTL = float(os.environ.get('AI_REPORT_CACHE_TTL', str(12 * 3600)))
+AI_REPORT_CACHE_SIZE = int(os.environ.get('AI_REPORT_CACHE_SIZE', '1000'))
+
+
+def report_digest(payload: str) -> str:
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ReportCache:
+    """
+    Кэш готовых ИИ-отчетов: по одному на чат, с хэшем входных данных.
+
+    Если данные за окно не изменились, повторное нажатие «Анализ ИИ» отдает
+    прошлый отчет без запроса к Gemini. Одновременные запросы с одинаковыми
+    данными ждут один общий вызов. Новый замер сбрасывает отчет чата.
+    """
+
+    def __init__(self, ttl=AI_REPORT_CACHE_TTL, max_entries=AI_REPORT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, chat_id, digest: str):
+        entry = self._entries.get(str(chat_id))
+        if not entry:
+            return None
+        cached_digest, text, created = entry
+        if cached_digest != digest or time.monotonic() - created > self.ttl:
+            return None
+        self._entries.move_to_end(str(chat_id))
+        return text
+
+    def put(self, chat_id, digest: str, text: str):
+        self._entries[str(chat_id)] = (digest, text, time.monotonic())
+        self._entries.move_to_end(str(chat_id))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id):
+        self._entries.pop(str(chat_id), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get_or_run(self, chat_id, digest: str, produce) -> tuple:
+        """
+        Возвращает (text, produced). produced=True — отчет только что создан
+        корутиной produce() (и она уже показала его пользователю), False —
+        текст взят из кэша или из параллельного вызова, его нужно отправить.
+        """
+        text = self.get(chat_id, digest)
+        if text is not None:
+            self.hits += 1
+            return text, False
+        key = (str(chat_id), digest)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight), False
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            text = await produce()
+            self.put(chat_id, digest, text)
+            future.set_result(text)
+            return text, True
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение получат ожидающие; если их нет, не оставляем его «непрочитанным»
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'inflight': len(self._inflight),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
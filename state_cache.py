@@ -0,0 +1,394 @@
+# state_cache.py
+import atexit
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass, field
+
+import utils
+
+# Через сколько секунд после изменения переписывать локальный JSON-файл
+LOCAL_FLUSH_DELAY = float(os.environ.get('STATE_LOCAL_FLUSH_DELAY', '2'))
+# Лимит операций в одном пакете записи Firestore
+_FIRESTORE_BATCH_LIMIT = 500
+_MIGRATED_FIELD = '_migrated_to_chat_documents'
+
+
+@dataclass
+class Profile:
+    dob: str = None
+    sex: str = None
+    first_name: str = None
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(dob=data.get('dob'), sex=data.get('sex'), first_name=data.get('first_name'))
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @property
+    def is_complete(self) -> bool:
+        return bool(self.dob and self.sex)
+
+
+@dataclass
+class Reminder:
+    times: list = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        # Поле jobs из старых записей больше не нужно: задачи строит ReminderSchedule
+        return cls(times=list(data.get('times') or []))
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class ChatDocumentStore:
+    """
+    Хранилище состояния «по документу на чат».
+
+    В Firestore каждая запись — отдельный документ artifacts/{app}/{коллекция}/{chat_id},
+    изменения пишутся merge-обновлением только этого документа. Локальный
+    JSON-файл остается резервной копией и переписывается с задержкой: серия
+    изменений дает одну запись файла.
+    """
+
+    def __init__(self, filename: str, flush_delay: float = LOCAL_FLUSH_DELAY):
+        self.filename = filename
+        self.flush_delay = flush_delay
+        self._local = {}
+        self._lock = threading.Lock()
+        self._timer = None
+        self._dirty = False
+        self._watch = None
+        atexit.register(self.flush_local)
+
+    # --- Загрузка ---
+
+    def load_all(self) -> dict:
+        """Все записи {chat_id: dict}; при первом запуске переносит данные из общего документа."""
+        collection = utils.firestore_collection(self.filename)
+        data = None
+        if collection is not None:
+            try:
+                migrate_global_blob(self.filename)
+                data = {doc.id: doc.to_dict() for doc in collection.stream()}
+            except Exception as e:
+                print(f"Ошибка загрузки из Firestore для {self.filename}: {e}.")
+        if data is None:
+            data = self._read_local()
+        with self._lock:
+            self._local = dict(data)
+        return data
+
+    def _read_local(self) -> dict:
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    # --- Запись ---
+
+    def put(self, chat_id: str, data: dict):
+        self.put_many({chat_id: data})
+
+    def put_many(self, items: dict):
+        """Merge-обновление документов перечисленных чатов; остальные чаты не затрагиваются."""
+        if not items:
+            return
+        with self._lock:
+            for chat_id, data in items.items():
+                self._local[str(chat_id)] = data
+        self._schedule_local_flush()
+        collection = utils.firestore_collection(self.filename)
+        if collection is None:
+            return
+        try:
+            pending = list(items.items())
+            for i in range(0, len(pending), _FIRESTORE_BATCH_LIMIT):
+                batch = utils.db_firestore.batch()
+                for chat_id, data in pending[i:i + _FIRESTORE_BATCH_LIMIT]:
+                    batch.set(collection.document(str(chat_id)), data, merge=True)
+                batch.commit()
+        except Exception as e:
+            print(f"Ошибка сохранения в Firestore для {self.filename}: {e}")
+
+    def delete(self, chat_id: str):
+        with self._lock:
+            self._local.pop(str(chat_id), None)
+        self._schedule_local_flush()
+        collection = utils.firestore_collection(self.filename)
+        if collection is None:
+            return
+        try:
+            collection.document(str(chat_id)).delete()
+        except Exception as e:
+            print(f"Ошибка удаления из Firestore для {self.filename}: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._local = {}
+        self._schedule_local_flush()
+        collection = utils.firestore_collection(self.filename)
+        if collection is None:
+            return
+        try:
+            refs = [doc.reference for doc in collection.stream()]
+            for i in range(0, len(refs), _FIRESTORE_BATCH_LIMIT):
+                batch = utils.db_firestore.batch()
+                for ref in refs[i:i + _FIRESTORE_BATCH_LIMIT]:
+                    batch.delete(ref)
+                batch.commit()
+        except Exception as e:
+            print(f"Ошибка очистки Firestore для {self.filename}: {e}")
+
+    # --- Локальная копия ---
+
+    def _schedule_local_flush(self):
+        with self._lock:
+            self._dirty = True
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.flush_delay, self.flush_local)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush_local(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            self._dirty = False
+            data = dict(self._local)
+        tmp_path = self.filename + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self.filename)
+        except Exception as e:
+            print(f"Ошибка сохранения в локальный файл {self.filename}: {e}")
+
+    # --- Подписка ---
+
+    def watch(self, on_change):
+        """
+        Подписывает on_change({chat_id: dict или None}) на изменения документов коллекции:
+        один вызов на снимок Firestore со всеми его изменениями.
+        """
+        collection = utils.firestore_collection(self.filename)
+        if collection is None or self._watch is not None:
+            return
+
+        def on_snapshot(docs, changes, read_time):
+            # Вызывается из потока Firestore
+            if not changes:
+                return
+            updates = {
+                change.document.id: None if change.type.name == 'REMOVED' else change.document.to_dict()
+                for change in changes
+            }
+            with self._lock:
+                for chat_id, data in updates.items():
+                    if data is None:
+                        self._local.pop(chat_id, None)
+                    else:
+                        self._local[chat_id] = data
+            on_change(updates)
+            self._schedule_local_flush()
+
+        try:
+            self._watch = collection.on_snapshot(on_snapshot)
+        except Exception as e:
+            print(f"Не удалось подписаться на изменения {self.filename} в Firestore: {e}")
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+        self.flush_local()
+
+
+def migrate_global_blob(filename: str) -> int:
+    """
+    Однократно переносит записи из общего документа global_data в документы
+    по чатам. Общий документ помечается как перенесенный и больше не читается.
+    Возвращает число перенесенных записей.
+    """
+    collection = utils.firestore_collection(filename)
+    legacy_ref = utils.firestore_document(filename, "global_data")
+    if collection is None or legacy_ref is None:
+        return 0
+    legacy = legacy_ref.get()
+    if not legacy.exists:
+        return 0
+    data = legacy.to_dict() or {}
+    if data.get(_MIGRATED_FIELD):
+        return 0
+    items = [(chat_id, value) for chat_id, value in data.items() if isinstance(value, (dict, list))]
+    for i in range(0, len(items), _FIRESTORE_BATCH_LIMIT):
+        batch = utils.db_firestore.batch()
+        for chat_id, value in items[i:i + _FIRESTORE_BATCH_LIMIT]:
+            # charts_sent хранит список месяцев, в документ он кладется полем
+            batch.set(collection.document(str(chat_id)), value if isinstance(value, dict) else {'months': value}, merge=True)
+        batch.commit()
+    legacy_ref.set({_MIGRATED_FIELD: True}, merge=True)
+    print(f"Перенесено записей из общего документа {filename}: {len(items)}")
+    return len(items)
+
+
+class StateCache:
+    """
+    Типизированная копия состояния по чатам (профили, напоминания) в памяти.
+
+    Данные читаются один раз при первом обращении, дальше все чтения идут
+    из памяти. Изменение записи сразу сохраняется в документ ее чата
+    (write-through), а изменения, сделанные другими экземплярами бота,
+    приходят через подписку Firestore на коллекцию.
+    """
+
+    def __init__(self, filename: str, item_type, store: ChatDocumentStore = None):
+        self.filename = filename
+        self.item_type = item_type
+        self.store = store or ChatDocumentStore(filename)
+        self._items = None
+        self._lock = threading.Lock()
+        # Чаты с незавершенной собственной записью: их снимки могут быть старее памяти
+        self._writing = {}
+        self._listeners = []
+
+    # --- Загрузка и подписка ---
+
+    def _parse_item(self, chat_id, data):
+        try:
+            return self.item_type.from_dict(data)
+        except (AttributeError, TypeError) as e:
+            print(f"Пропускаю поврежденную запись {chat_id} в {self.filename}: {e}")
+            return None
+
+    def _ensure_loaded(self) -> dict:
+        items = self._items
+        if items is not None:
+            return items
+        with self._lock:
+            if self._items is None:
+                parsed = {str(chat_id): self._parse_item(chat_id, data) for chat_id, data in self.store.load_all().items()}
+                self._items = {chat_id: item for chat_id, item in parsed.items() if item is not None}
+                self.store.watch(self._on_changes)
+            return self._items
+
+    def _on_changes(self, updates: dict):
+        # Первый снимок Firestore повторяет все документы как ADDED: одна копия
+        # словаря на снимок, а совпадающие с памятью записи не трогаем вовсе
+        parsed = {
+            chat_id: self._parse_item(chat_id, data) if data is not None else None
+            for chat_id, data in updates.items()
+        }
+        changed = []
+        with self._lock:
+            if self._items is None:
+                return
+            items = None
+            for chat_id, item in parsed.items():
+                if self._writing.get(chat_id):
+                    continue
+                current = self._items.get(chat_id)
+                if item is None and current is None or item is not None and item == current:
+                    continue
+                if items is None:
+                    items = dict(self._items)
+                if item is None:
+                    del items[chat_id]
+                else:
+                    items[chat_id] = item
+                changed.append((chat_id, item))
+            if items is not None:
+                self._items = items
+        for chat_id, item in changed:
+            self._notify(chat_id, item)
+
+    def add_listener(self, callback):
+        """callback(chat_id, запись или None) вызывается при каждом изменении, в том числе из Firestore."""
+        self._listeners.append(callback)
+
+    def _notify(self, chat_id: str, item):
+        for callback in self._listeners:
+            try:
+                callback(chat_id, item)
+            except Exception as e:
+                print(f"Ошибка обработчика изменений {self.filename}: {e}")
+
+    def stop(self):
+        self.store.stop()
+
+    # --- Чтение ---
+
+    def get(self, chat_id):
+        return self._ensure_loaded().get(str(chat_id))
+
+    def __contains__(self, chat_id) -> bool:
+        return str(chat_id) in self._ensure_loaded()
+
+    def items(self) -> list:
+        return list(self._ensure_loaded().items())
+
+    # --- Запись ---
+
+    def _begin_write(self, chat_id: str):
+        self._writing[chat_id] = self._writing.get(chat_id, 0) + 1
+
+    def _end_write(self, chat_id: str):
+        with self._lock:
+            self._writing[chat_id] -= 1
+            if not self._writing[chat_id]:
+                del self._writing[chat_id]
+
+    def set(self, chat_id, item):
+        chat_id = str(chat_id)
+        self._ensure_loaded()
+        with self._lock:
+            # Копия при записи: читатели всегда видят целый словарь
+            self._items = {**self._items, chat_id: item}
+            self._begin_write(chat_id)
+        self._notify(chat_id, item)
+        try:
+            self.store.put(chat_id, item.to_dict())
+        finally:
+            self._end_write(chat_id)
+
+    def delete(self, chat_id) -> bool:
+        chat_id = str(chat_id)
+        self._ensure_loaded()
+        with self._lock:
+            if chat_id not in self._items:
+                return False
+            self._items = {k: v for k, v in self._items.items() if k != chat_id}
+            self._begin_write(chat_id)
+        self._notify(chat_id, None)
+        try:
+            self.store.delete(chat_id)
+        finally:
+            self._end_write(chat_id)
+        return True
+
+    def clear(self):
+        self._ensure_loaded()
+        with self._lock:
+            removed, self._items = list(self._items), {}
+        for chat_id in removed:
+            self._notify(chat_id, None)
+        self.store.clear()
+
+
+if __name__ == '__main__':
+    import sys
+
+    # Ручной перенос: python state_cache.py migrate
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        utils.initialize_firebase_admin_sdk()
+        for name in ("profiles.json", "reminders.json", "charts_sent.json"):
+            migrate_global_blob(name)
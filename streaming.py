@@ -0,0 +1,94 @@
+# streaming.py
+import asyncio
+import os
+
+from telegram.error import BadRequest, RetryAfter
+
+# Telegram ограничивает частоту правок одного сообщения (~1 в секунду на чат)
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', '1.0'))
+STREAM_ENABLED = os.environ.get('STREAM_REPLIES', '1') != '0'
+# Максимальная длина текста одного сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+
+class EmptyReplyError(Exception):
+    """Модель не вернула текста (ответ заблокирован фильтрами безопасности или пуст)."""
+
+
+def require_text(text: str) -> str:
+    """Возвращает text или выбрасывает EmptyReplyError: пустой ответ нельзя ни показать, ни сохранить."""
+    if not text or not text.strip():
+        raise EmptyReplyError("Модель вернула пустой ответ.")
+    return text
+
+
+async def gemini_text_chunks(response):
+    """Превращает потоковый ответ Gemini в асинхронный поток фрагментов текста."""
+    async for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Фрагмент без текста (например, только метаданные безопасности)
+            continue
+        if text:
+            yield text
+
+
+class _StreamedMessage:
+    """Одно сообщение Telegram, которое дописывается правками."""
+
+    def __init__(self, reply_to, reply_kwargs):
+        self.reply_to = reply_to
+        self.reply_kwargs = reply_kwargs
+        self.message = None
+        self.shown = ""
+
+    async def show(self, text):
+        if text == self.shown or not text.strip():
+            return
+        while True:
+            try:
+                if self.message is None:
+                    self.message = await self.reply_to.reply_text(text, **self.reply_kwargs)
+                else:
+                    await self.message.edit_text(text)
+                self.shown = text
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    self.shown = text
+                    return
+                raise
+
+
+async def stream_reply(reply_to, chunks, min_interval=STREAM_EDIT_INTERVAL, **reply_kwargs) -> str:
+    """
+    Отправляет ответ по мере генерации: первый фрагмент — новым сообщением,
+    дальше правит его не чаще min_interval секунд. Текст длиннее лимита
+    Telegram продолжается в следующем сообщении. Возвращает полный текст;
+    если модель не прислала ни одного фрагмента текста — EmptyReplyError.
+    """
+    loop = asyncio.get_running_loop()
+    text = ""
+    offset = 0
+    current = _StreamedMessage(reply_to, reply_kwargs)
+    last_edit = 0.0
+
+    async for piece in chunks:
+        text += piece
+        # Заполненное сообщение фиксируем и начинаем следующее
+        while len(text) - offset > MESSAGE_LIMIT:
+            await current.show(text[offset:offset + MESSAGE_LIMIT])
+            offset += MESSAGE_LIMIT
+            current = _StreamedMessage(reply_to, reply_kwargs)
+            last_edit = 0.0
+        now = loop.time()
+        if current.message is None or now - last_edit >= min_interval:
+            await current.show(text[offset:])
+            last_edit = loop.time()
+
+    require_text(text)
+    await current.show(text[offset:])
+    return text
@@ -1,12 +1,16 @@
 # utils.py
 import json
 import os
+import threading
 from datetime import datetime, date, timezone, timedelta
 import gspread
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2.service_account import Credentials
 import firebase_admin
 from firebase_admin import credentials, firestore
 
+from metrics import timed
+
 # --- Глобальные переменные ---
 db_firestore = None
 app_id_global = None
@@ -34,64 +38,109 @@ def initialize_firebase_admin_sdk():
     except Exception as e:
         print(f"Критическая ошибка при инициализации Firebase: {e}")
 
-def get_sheet():
+class SheetsClient:
     """
-    Подключается к Google Таблице и возвращает рабочий лист.
-    Использует ключ и URL из переменных окружения.
+    Единый на процесс клиент Google Sheets.
+    Авторизуется один раз, переиспользует HTTP-сессию gspread,
+    заранее обновляет токен и кэширует открытые рабочие листы.
     """
-    try:
+
+    SCOPES = [
+        'https://www.googleapis.com/auth/spreadsheets',
+        'https://www.googleapis.com/auth/drive',
+    ]
+    # За сколько до истечения токена обновлять его заранее
+    REFRESH_MARGIN = timedelta(minutes=5)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._creds = None
+        self._client = None
+        self._spreadsheet = None
+        self._worksheets = {}
+
+    def _connect(self):
         creds_json_str = os.environ.get('GSPREAD_CREDENTIALS')
         spreadsheet_url = os.environ.get('SPREADSHEET_URL')
 
         if not creds_json_str:
             print("Критическая ошибка: переменная окружения GSPREAD_CREDENTIALS не найдена.")
-            return None
+            return False
         if not spreadsheet_url:
             print("Критическая ошибка: переменная окружения SPREADSHEET_URL не найдена.")
-            return None
+            return False
 
         creds_dict = json.loads(creds_json_str)
-        creds = Credentials.from_service_account_info(creds_dict)
-        client = gspread.authorize(creds)
-
+        self._creds = Credentials.from_service_account_info(creds_dict, scopes=self.SCOPES)
+        with timed('sheets', 'connect'):
+            self._client = gspread.authorize(self._creds)
+            self._spreadsheet = self._client.open_by_url(spreadsheet_url)
+        self._worksheets = {}
         print("Успешно подключился к Google API (gspread).")
-        return client.open_by_url(spreadsheet_url).sheet1
+        return True
+
+    def _refresh_if_needed(self):
+        expiry = self._creds.expiry
+        if self._creds.valid and expiry and expiry - datetime.utcnow() > self.REFRESH_MARGIN:
+            return
+        with timed('google_auth', 'refresh'):
+            self._creds.refresh(GoogleAuthRequest())
+
+    def spreadsheet(self):
+        with self._lock:
+            if self._spreadsheet is None and not self._connect():
+                return None
+            self._refresh_if_needed()
+            return self._spreadsheet
+
+    def worksheet(self, title: str = None):
+        """Возвращает рабочий лист по имени (по умолчанию — первый) из кэша."""
+        spreadsheet = self.spreadsheet()
+        if spreadsheet is None:
+            return None
+        key = title or ''
+        with self._lock:
+            if key not in self._worksheets:
+                with timed('sheets', 'open_worksheet'):
+                    self._worksheets[key] = spreadsheet.worksheet(title) if title else spreadsheet.sheet1
+            return self._worksheets[key]
+
+    def reset(self):
+        """Сбрасывает подключение, например после ошибки авторизации."""
+        with self._lock:
+            self._creds = None
+            self._client = None
+            self._spreadsheet = None
+            self._worksheets = {}
+
+sheets_client = SheetsClient()
+
+def get_sheet():
+    """
+    Возвращает первый рабочий лист Google Таблицы.
+    Подключение создается один раз на процесс и переиспользуется.
+    """
+    try:
+        return sheets_client.worksheet()
     except Exception as e:
         print(f"Критическая ошибка при подключении к Google Sheets: {e}")
+        sheets_client.reset()
         return None
 
-def load_json_with_firestore_sync(filename: str, telegram_chat_id: str = None) -> dict:
+def firestore_document(filename: str, telegram_chat_id: str = None):
+    """Ссылка на документ Firestore, в котором хранится содержимое filename (или None без Firestore)."""
+    if not db_firestore:
+        return None
     collection_name = os.path.splitext(filename)[0]
-    doc_id = "data"
-    if db_firestore:
-        user_id_for_path = telegram_chat_id if telegram_chat_id else "global_data"
-        doc_ref = db_firestore.collection('artifacts').document(app_id_global).collection('users').document(user_id_for_path).collection(collection_name).document(doc_id)
-        try:
-            doc = doc_ref.get()
-            if doc.exists: return doc.to_dict()
-        except Exception as e:
-            print(f"Ошибка загрузки из Firestore для {filename}: {e}.")
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+    user_id_for_path = telegram_chat_id if telegram_chat_id else "global_data"
+    return db_firestore.collection('artifacts').document(app_id_global).collection('users').document(user_id_for_path).collection(collection_name).document("data")
 
-def save_json_with_firestore_sync(data: dict, filename: str, telegram_chat_id: str = None):
+def firestore_collection(filename: str):
+    """Коллекция Firestore с отдельным документом на каждый чат (или None без Firestore)."""
+    if not db_firestore:
+        return None
     collection_name = os.path.splitext(filename)[0]
-    doc_id = "data"
-    try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-    except Exception as e:
-        print(f"Ошибка сохранения в локальный файл {filename}: {e}")
-    if db_firestore:
-        user_id_for_path = telegram_chat_id if telegram_chat_id else "global_data"
-        doc_ref = db_firestore.collection('artifacts').document(app_id_global).collection('users').document(user_id_for_path).collection(collection_name).document(doc_id)
-        try:
-            doc_ref.set(data)
-        except Exception as e:
-            print(f"Ошибка сохранения в Firestore для {filename}: {e}")
+    return db_firestore.collection('artifacts').document(app_id_global).collection(collection_name)
 
 def calculate_age(dob_str: str) -> str | None:
     if not isinstance(dob_str, str): return None